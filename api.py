@@ -7,7 +7,8 @@ from protorpc import remote
 import apimessages
 import util
 
-from models.recipe import Recipe
+from models.recipe import Recipe, RecipeHistory
+from models.recipepath import RecipePath
 from models.userprefs import UserPrefs
 
 
@@ -16,6 +17,7 @@ EMAIL_SCOPE = 'https://www.googleapis.com/auth/userinfo.email'
 
 USER_NOT_FOUND = 'Invalid user name.'
 RECIPE_NOT_FOUND = 'Invalid recipe slug.'
+VERSION_NOT_FOUND = 'Invalid recipe version.'
 
 
 def oauth_required(func):
@@ -82,13 +84,10 @@ def recipe_to_response(recipe):
     yeasts = []
 
     for fermentable in recipe.ingredients['fermentables']:
-        if 'late' not in fermentable:
-            fermentable['late'] = False
-
         fermentables.append(apimessages.FermentableResponse(**{
             'weight_kg': fermentable['weight'] * util.LB_TO_KG,
             'description': fermentable['description'],
-            'late': fermentable['late'] and True or False,
+            'late': fermentable.is_late,
             'color': float(fermentable['color']),
             'yield_ratio': fermentable['ppg'] / 46.214
         }))
@@ -96,7 +95,7 @@ def recipe_to_response(recipe):
     for spice in recipe.ingredients['spices']:
         spices.append(apimessages.SpiceResponse(**{
             'use': spice['use'],
-            'time': int(util.time_to_min(spice['time']) * 60),
+            'time': int(spice.minutes * 60),
             'weight_kg': float(spice['oz'] * util.OZ_TO_KG),
             'description': spice['description'],
             'form': spice['form'],
@@ -190,7 +189,7 @@ class MaltioApi(remote.Service):
         """
         Get a user by name.
         """
-        publicuser = UserPrefs.all().filter('name =', request.user_name).get()
+        publicuser = UserPrefs.get_by_name(request.user_name)
 
         if not publicuser:
             raise endpoints.NotFoundException(USER_NOT_FOUND)
@@ -209,7 +208,7 @@ class MaltioApi(remote.Service):
         offset, limit = get_limits(request)
 
         if request.user_name:
-            publicuser = UserPrefs.all().filter('name =', request.user_name).get()
+            publicuser = UserPrefs.get_by_name(request.user_name)
 
             if not publicuser:
                 raise endpoints.NotFoundException(USER_NOT_FOUND)
@@ -229,6 +228,7 @@ class MaltioApi(remote.Service):
             query = query.order('-likes_count')
 
         recipes = query.fetch(limit, offset=offset)
+        recipes = Recipe.prefetch_owners(recipes)
 
         items = []
         for recipe in recipes:
@@ -246,19 +246,27 @@ class MaltioApi(remote.Service):
                       name='recipes.get')
     def get_recipe(self, request):
         """
-        Get a recipe by user name and recipe slug.
+        Get a recipe by user name and recipe slug, optionally as it was at
+        a historic version.
         """
-        publicuser = UserPrefs.all().filter('name =', request.user_name).get()
+        publicuser, recipe = RecipePath.resolve(request.user_name, request.slug)
 
         if not publicuser:
             raise endpoints.NotFoundException(USER_NOT_FOUND)
 
-        recipe = Recipe.all()\
-                       .filter('owner =', publicuser)\
-                       .filter('slug =', request.slug)\
-                       .get()
-
         if not recipe:
             raise endpoints.NotFoundException(RECIPE_NOT_FOUND)
 
+        if request.version:
+            history = RecipeHistory.get_by_id(request.version, parent=recipe)
+
+            if not history:
+                raise endpoints.NotFoundException(VERSION_NOT_FOUND)
+
+            # Return the version under the name it had at the time
+            recipe = recipe.materialize_version(history)
+            recipe.name = recipe.oldname
+
+        recipe.owner = publicuser
+
         return recipe_to_response(recipe)
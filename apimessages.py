@@ -76,9 +76,11 @@ class RecipeGetRequest(messages.Message):
 
     user_name: The user's unique name
     slug: The recipe's unique slug
+    version: An optional historic version number of the recipe
     """
     user_name = messages.StringField(1, required=True)
     slug = messages.StringField(2, required=True)
+    version = messages.IntegerField(3)
 
 
 class FermentableResponse(messages.Message):
@@ -0,0 +1,26 @@
+from google.appengine.ext import deferred
+from handlers.base import BaseHandler
+
+import migrations
+
+
+class MigrationHandler(BaseHandler):
+    """
+    Start a data migration in the background via the task queue. Only
+    application admins may access this handler, which is enforced by
+    app.yaml. It is invoked via URLs like:
+
+        /admin/migrate/NAME
+
+    """
+    def get(self, name):
+        """
+        Queue the named migration, see migrations.MIGRATIONS.
+        """
+        if name not in migrations.MIGRATIONS:
+            self.abort(404)
+
+        deferred.defer(migrations.MIGRATIONS[name])
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('Migration %s started\n' % name)
@@ -1,4 +1,7 @@
+import hashlib
+import identity
 import json
+import settings
 import webapp2
 
 from google.appengine.api import memcache
@@ -17,6 +20,9 @@ class BaseHandler(webapp2.RequestHandler):
         # Get a session store for this request.
         self.session_store = sessions.get_store(request=self.request)
 
+        # Load each entity at most once during this request
+        identity.start()
+
         try:
             # Dispatch the request.
             super(BaseHandler, self).dispatch()
@@ -24,6 +30,8 @@ class BaseHandler(webapp2.RequestHandler):
             # Save all sessions.
             self.session_store.save_sessions(self.response)
 
+            identity.clear()
+
     @webapp2.cached_property
     def session(self):
         """Returns a session using the default cookie key"""
@@ -49,6 +57,46 @@ class BaseHandler(webapp2.RequestHandler):
         """Returns true if a user is currently logged in, false otherwise"""
         return self.session.get('auth_id') is not None
 
+    def not_modified(self, validators, last_modified=None, max_age=60):
+        """
+        Set conditional GET headers for a response which only changes when
+        one of the validators changes, e.g. a recipe key and edit time.
+        Returns True after setting a 304 Not Modified response if the
+        client's copy is still current, in which case nothing should be
+        rendered.
+
+        Responses to logged in users include the user in the ETag and are
+        only cached privately, while anonymous responses may be cached by
+        shared caches for max_age seconds.
+        """
+        validators = [settings.VERSION] + list(validators)
+
+        if self.logged_in:
+            validators.append(self.user and self.user.key())
+            self.response.headers['Cache-Control'] = 'private, max-age=0'
+        else:
+            self.response.headers['Cache-Control'] = 'public, max-age=%d' % max_age
+
+        self.response.headers['Vary'] = 'Cookie'
+
+        etag = hashlib.md5('-'.join([str(v) for v in validators])).hexdigest()
+        self.response.etag = etag
+
+        if last_modified:
+            self.response.last_modified = last_modified
+
+        # Only the ETag decides whether the client's copy is current, since
+        # unlike the modification time it changes with every deploy, which
+        # may change the rendered markup. Last-Modified is only sent for
+        # information.
+        fresh = bool(self.request.if_none_match) and \
+                etag in self.request.if_none_match
+
+        if fresh:
+            self.response.status = 304
+
+        return fresh
+
     def render(self, template, params=None, write_to_stream=True):
         """Render a template"""
         return render(self, template, params, write_to_stream)
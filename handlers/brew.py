@@ -6,39 +6,30 @@ from contrib.paodate import Date
 from handlers.base import BaseHandler
 from models.brew import Brew
 from models.recipe import Recipe
+from models.recipepath import RecipePath
+from models.slugreservation import SlugReservation
 from models.useraction import UserAction
-from models.userprefs import UserPrefs
 from util import slugify
 
 
 def generate_usable_slug(brew):
     """
-    Generate a usable slug for a given brew. This method will try to slugify
-    the brew date + owner and then append an integer if needed, increasing this
-    integer until no existing brew would be overwritten.
+    Generate a usable slug for a given brew. This method will slugify the
+    brew date + owner and reserve it among the owner's brews of the recipe,
+    appending the next free integer if it is already taken, see
+    SlugReservation.
     """
     base = brew.started.strftime('%d-%b-%Y') + '-' + brew.owner.name
     slug = slugify(base)
 
     # Reuse existing slug if we can
-    if brew.slug and brew.slug == slug:
+    if brew.slug and SlugReservation.reserved(brew.owner_key, 'Brew',
+                                              brew.recipe_key.id(), slug,
+                                              brew.slug):
         return brew.slug
 
-    append = 0
-    while True:
-        count = Brew.all()\
-                    .filter('owner =', brew.owner)\
-                    .filter('recipe =', brew.recipe)\
-                    .filter('slug =', slug)\
-                    .count()
-
-        if not count:
-            break
-
-        append += 1
-        slug = slugify(base) + str(append)
-
-    return slug
+    return SlugReservation.reserve(brew.owner_key, 'Brew',
+                                   brew.recipe_key.id(), slug)
 
 
 class BrewHandler(BaseHandler):
@@ -49,18 +40,11 @@ class BrewHandler(BaseHandler):
         /users/USERNAME/recipes/RECIPE-SLUG/brew/BREW-SLUG
     """
     def process(self, username=None, recipe_slug=None, brew_slug=None):
-        publicuser = UserPrefs.all()\
-                              .filter('name =', username)\
-                              .get()
+        publicuser, recipe = RecipePath.resolve(username, recipe_slug)
 
         if not publicuser:
             return [None, None, None]
 
-        recipe = Recipe.all()\
-                       .filter('owner =', publicuser)\
-                       .filter('slug = ', recipe_slug)\
-                       .get()
-
         if not recipe:
             return [publicuser, None, None]
 
@@ -126,12 +110,16 @@ class BrewHandler(BaseHandler):
         brew.rating = submitted['rating']
         brew.notes = submitted['notes']
 
+        old_slug = brew.slug
         brew.slug = generate_usable_slug(brew)
         key = brew.put()
 
+        if old_slug and old_slug != brew.slug:
+            SlugReservation.release(brew.owner_key, 'Brew',
+                                    brew.recipe_key.id(), old_slug)
+
         # Update recipe ranking information for sorting
-        recipe.update_grade()
-        recipe.put()
+        Recipe.add_brew(recipe.key(), brew, new=not brew_slug)
 
         # Add user action
         action = UserAction()
@@ -145,6 +133,9 @@ class BrewHandler(BaseHandler):
 
         action.put()
 
+        if not brew_slug:
+            self.user.adjust_count('brew_count')
+
         self.render_json({
             'status': 'ok'
         })
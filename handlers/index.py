@@ -1,44 +1,69 @@
-import logging
-import settings
-
-from google.appengine.api import memcache
 from google.appengine.ext import db
-from google.appengine.ext.db import Key
 from handlers.base import BaseHandler
-from models.recipe import Recipe
+from invalidation import subscribe, RECIPE_CHANGED, USER_CHANGED, \
+                         TIMELINE_CHANGED
+from models.recipesummary import RecipeSummary
+from models.timeline import TimelineChunk
 from models.useraction import UserAction
-from models.userprefs import UserPrefs
-from util import login_required
+from util import cached_fragment, login_required, bump_cache_version
+
+
+@subscribe(RECIPE_CHANGED)
+@subscribe(USER_CHANGED)
+def invalidate_index_recipes(entity):
+    """
+    Invalidate the index page recipe list, which shows recipes and the
+    names of their owners.
+    """
+    bump_cache_version('index-recipes')
+
+
+@subscribe(USER_CHANGED)
+def invalidate_user_dashboards(user):
+    """
+    Invalidate the dashboards showing a user, i.e. her own and those of
+    her followers.
+    """
+    bump_cache_version('user-' + user.user_id)
+
+
+@subscribe(TIMELINE_CHANGED)
+def invalidate_timeline_dashboard(user_key):
+    """
+    Invalidate a user's dashboard when her timeline changes.
+    """
+    bump_cache_version('timeline-' + str(user_key.id()))
 
 
 class MainHandler(BaseHandler):
     """
     Handle requests to the index page, i.e. http://www.malt.io/
     """
-    # Time in seconds to cache parts of the page
-    CACHE_TIME = 2 * 60 * 60
-
     def get(self):
         """
         Render the index page. Currently this renders a 'Coming soon' landing
         page that will eventually be replaced with a proper home page.
         """
-        # Try to get recipes list from memcache instead of datastore
-        recipes_html = memcache.get('index-recipes')
-        if not recipes_html or settings.DEBUG:
-            # No such luck... query the data store
-            recipes = Recipe.all()\
-                            .order('-grade')\
-                            .run(limit=15)
-            recipes_html = self.render('index-recipes.html', {
-                'recipes': recipes
-            }, write_to_stream=False)
-            memcache.set('index-recipes', recipes_html, self.CACHE_TIME)
+        # The recipe list is cached until any recipe or user changes
+        recipes_html = cached_fragment('index-recipes', self.render_recipes,
+                                       ['index-recipes'])
 
         self.render('index.html', {
             'recipes_html': recipes_html
         })
 
+    def render_recipes(self):
+        """
+        Render the list of top recipes shown on the index page.
+        """
+        recipes = RecipeSummary.all()\
+                               .order('-grade')\
+                               .fetch(15)
+
+        return self.render('index-recipes.html', {
+            'recipes': recipes
+        }, write_to_stream=False)
+
 
 class AboutHandler(BaseHandler):
     """A basic about page"""
@@ -51,89 +76,62 @@ class DashboardHandler(BaseHandler):
     Render the user's dashboard with info about her recipes, followers,
     actions, etc.
     """
-    # Time in seconds to cache parts of the page
-    CACHE_TIME = 60
-    
-    @login_required
-    def get(self):
-        user = self.user
-
-        # Try to get rendered output from memcache
-        rendered = memcache.get('dashboard-' + user.user_id)
-        if rendered and not settings.DEBUG:
-            return self.response.out.write(rendered)
-
-        # Fetch following users
-        following = user.following_users\
-                        .order('name')\
-                        .fetch(100)
-
-        user_keys = [user.key()] + [u.key() for u in following]
-
-        # Start async fetch of top recipes
-        top_recipes = Recipe.all()\
-                            .filter('owner IN', user_keys)\
-                            .order('-grade')\
-                            .run(limit=15)
-
-        # Get and process interesting events
-        interesting_events = UserAction.all()\
-                                       .filter('owner IN', user_keys)\
-                                       .order('-created')\
-                                       .fetch(15)
-
-        object_ids = UserAction.gather_object_ids(interesting_events)
-        object_ids['users'] = [id for id in object_ids['users'] if id not in [user.key().id()] + user.following]
+    # Time in seconds to cache parts of the page. Changes to the users and
+    # timeline shown invalidate the cache, so this only bounds how stale
+    # the recipe rankings can get.
+    CACHE_TIME = 60 * 60
 
-        # Start async fetch of relevant recipes
-        recipes = db.get_async([Key.from_path('Recipe', id) for id in object_ids['recipes']])
+    # Number of recent events to show
+    EVENT_COUNT = 15
 
-        # Start async fetch of relevant brews
-        brews = db.get_async([Key.from_path('Brew', id) for id in object_ids['brews']])
+    # Number of timeline actions from which top recipes are chosen
+    TIMELINE_SIZE = 50
 
-        # Convert iterators to  lists of items in memory and setup a map
-        # of user id -> user for easy lookups
-        following = list(following)
-        top_recipes = list(top_recipes)
-
-        user_map = {
-            user.key().id(): user
-        }
+    @login_required
+    def get(self):
+        user = self.user
 
-        for u in following:
-            user_map[u.key().id()] = u
+        # The dashboard content is cached until the user, anyone she follows
+        # or her timeline changes. The page header around it shows changing
+        # details like the unread message count, so it is not cached.
+        deps = ['user-' + user_id for user_id in [user.user_id] + user.following]
+        deps.append('timeline-' + str(user.key().id()))
 
-        if object_ids['users']:
-            for u in UserPrefs.get_by_id(object_ids['users']):
-                user_map[u.key().id()] = u
+        content_html = cached_fragment('dashboard-' + user.user_id,
+                                       self.render_dashboard, deps,
+                                       self.CACHE_TIME)
 
-        # Setup a map of brew id -> brew for easy lookups
-        brew_map = {}
-        brew_recipe_ids = set()
+        self.render('dashboard.html', {
+            'content_html': content_html
+        })
 
-        for b in brews.get_result():
-            brew_recipe_ids.add(b.recipe_key.id())
-            brew_map[b.key().id()] = b
+    def render_dashboard(self):
+        """
+        Render the dashboard content for the current user.
+        """
+        user = self.user
 
-        # Async fetch of any recipes brews reference that weren't
-        # included in the recipe fetch above...
-        brew_recipes = db.get_async([Key.from_path('Recipe', id) for id in brew_recipe_ids if id not in object_ids['recipes']])
+        # Fetch following users
+        following = sorted(user.following_users, key=lambda u: u.name)
 
-        # Setup a map of recipe id -> recipe for easy lookups
-        recipe_map = {}
+        # Get recent actions from the user's timeline, which already
+        # includes the actions of everyone she follows
+        actions = [action for action in db.get(TimelineChunk.recent_actions(user, self.TIMELINE_SIZE))
+                   if action]
+        interesting_events = actions[:self.EVENT_COUNT]
 
-        for r in recipes.get_result():
-            recipe_map[r.key().id()] = r
+        # Load everything the actions refer to
+        user_map, recipe_map, brew_map = UserAction.resolve(actions,
+                                                            users=[user] + following)
 
-        for r in brew_recipes.get_result():
-            recipe_map[r.key().id()] = r
+        # Top recipes are the best graded among recent activity
+        top_recipes = sorted(recipe_map.values(), key=lambda r: r.grade, reverse=True)[:15]
 
-        # Render and cache for 1 minute
-        memcache.set('dashboard-' + user.user_id, self.render('dashboard.html', {
+        return self.render('dashboard-content.html', {
             'following': following,
             'user_map': user_map,
             'recipe_map': recipe_map,
             'brew_map': brew_map,
             'top_recipes': top_recipes,
             'interesting_events': interesting_events
-        }), self.CACHE_TIME)
+        }, write_to_stream=False)
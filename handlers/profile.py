@@ -1,9 +1,11 @@
 import cgi
 import settings
 
-from google.appengine.api import memcache
-from google.appengine.ext import db
+from google.appengine.ext import db, deferred
 from handlers.base import BaseHandler
+from models.recipepath import RecipePath
+from models.recipesummary import RecipeSummary
+from models.username import Username
 from models.userprefs import UserPrefs
 from util import render, login_required
 
@@ -48,6 +50,14 @@ class ProfileHandler(BaseHandler):
         if not user:
             self.redirect('/profile')
 
+        # Claim the new name before giving up the old one, so that no one
+        # else can take it in between
+        old_name = user.name
+        renamed = old_name != name
+
+        if renamed and not Username.claim(name, user.key()):
+            return self.redirect('/profile')
+
         # Set the values and save to the data store
         user.name = name
         user.email = email
@@ -63,8 +73,11 @@ class ProfileHandler(BaseHandler):
         
         user.put()
 
-        # Invalidate cached user list pages
-        memcache.delete('users-content')
+        # Move the user's recipe URLs and summaries over to the new name
+        if renamed:
+            Username.release(old_name, user.key())
+            deferred.defer(RecipePath.reindex, user.key())
+            deferred.defer(RecipeSummary.rename_owner, user.key())
 
         # Redirect to show a success message to the user
         self.redirect('/profile?success=1')
@@ -1,49 +1,81 @@
 # content: utf-8
 
 import cgi
+import hashlib
 import json
-import logging
+import settings
 import webapp2
 
 from contrib.paodate import Date
 from handlers.base import BaseHandler
+from invalidation import subscribe, RECIPE_CHANGED, USER_CHANGED, \
+                         BREW_CHANGED
+from models.brew import Brew
 from models.recipe import Recipe, RecipeHistory
+from models.recipepath import RecipePath
+from models.recipesummary import RecipeSummary
+from models.slugreservation import SlugReservation
 from models.useraction import UserAction
 from models.userprefs import UserPrefs
-from util import render, render_json, slugify
+from util import render, render_json, slugify, cached_fragment, \
+                 bump_cache_version, get_cache_versions, get_template, \
+                 FRAGMENT_CACHE_TIME
 from webapp2 import redirect
 from webapp2_extras.appengine.users import login_required
+from google.appengine.api import memcache
 from google.appengine.ext import db
 from operator import itemgetter
 from datetime import timedelta
 
 
+@subscribe(RECIPE_CHANGED)
+def invalidate_recipe_lists(recipe):
+    """
+    Invalidate the cached pages of the global recipe list and the owner's
+    recipe list when a recipe changes.
+    """
+    bump_cache_version('recipes')
+
+    if recipe.owner_key:
+        bump_cache_version('recipes-' + str(recipe.owner_key.id()))
+
+
+@subscribe(USER_CHANGED)
+def invalidate_user_recipe_lists(user):
+    """
+    Recipe lists show owner names, so invalidate the global list and the
+    user's own list when a user changes.
+    """
+    bump_cache_version('recipes')
+    bump_cache_version('recipes-' + str(user.key().id()))
+
+
+@subscribe(BREW_CHANGED)
+def invalidate_recipe_page(brew):
+    """
+    The recipe page lists recent brews, so a changed brew invalidates the
+    page of its recipe.
+    """
+    recipe_key = Brew.recipe.get_value_for_datastore(brew)
+
+    if recipe_key:
+        bump_cache_version('recipe-' + str(recipe_key.id()))
+
+
 def generate_usable_slug(recipe):
     """
-    Generate a usable slug for a given recipe. This method will try to slugify
-    the recipe name and then append an integer if needed, increasing this
-    integer until no existing recipe would be overwritten.
+    Generate a usable slug for a given recipe. This method will slugify the
+    recipe name and reserve it for the owner, appending the next free
+    integer if it is already taken, see SlugReservation.
     """
     slug = slugify(recipe.name)
 
     # Reuse existing slug if we can
-    if recipe.slug and recipe.slug == slug:
+    if recipe.slug and SlugReservation.reserved(recipe.owner_key, 'Recipe', '',
+                                                slug, recipe.slug):
         return recipe.slug
 
-    append = 0
-    while True:
-        count = Recipe.all()\
-                      .filter('owner =', recipe.owner)\
-                      .filter('slug =', slug)\
-                      .count()
-
-        if not count:
-            break
-
-        append += 1
-        slug = slugify(recipe.name) + str(append)
-
-    return slug
+    return SlugReservation.reserve(recipe.owner_key, 'Recipe', '', slug)
 
 
 class RecipesHandler(BaseHandler):
@@ -55,32 +87,71 @@ class RecipesHandler(BaseHandler):
         /users/USERNAME/recipes
 
     """
+    # Number of recipes to show per page
+    PAGE_SIZE = 24
+
     def get(self, username=None):
         """
-        Render the public recipe list for a user or all users.
+        Render the public recipe list for a user or all users. The list is
+        paged via an opaque cursor passed in the `cursor` query parameter,
+        and each rendered page is cached until a recipe in the list changes.
         """
-        show_owners = False
+        cursor = self.request.get('cursor') or None
+
         if username:
-            publicuser = UserPrefs.all().filter('name =', username).get()
-            recipes = Recipe.all()\
-                            .filter('owner =', publicuser)\
-                            .order('-grade')
-            def setowner(recipe):
-                recipe.owner = publicuser
-                return recipe
-            recipes = map(setowner, recipes)
+            publicuser = UserPrefs.get_by_name(username)
+
+            if not publicuser:
+                self.abort(404)
+
+            deps = ['recipes-' + str(publicuser.key().id())]
         else:
             publicuser = None
-            recipes = Recipe.all().order('-grade')
-            recipes = [r for r in recipes]
-            show_owners = True
+            deps = ['recipes']
+
+        name = 'recipes-page-' + (cursor and hashlib.md5(cursor).hexdigest() or 'first')
+
+        recipes_html = cached_fragment(name, lambda: self.render_page(publicuser, cursor),
+                                       deps)
 
         self.render('recipes.html', {
             'publicuser': publicuser,
-            'recipes': recipes,
-            'show_owners': show_owners
+            'recipes_html': recipes_html
         })
 
+    def render_page(self, publicuser, cursor):
+        """
+        Render a single page of the recipe list, starting at the given
+        cursor if one is passed.
+        """
+        query = RecipeSummary.all()
+
+        if publicuser:
+            query = query.filter('owner =', publicuser)
+
+        query = query.order('-grade')
+
+        try:
+            if cursor:
+                query = query.with_cursor(cursor)
+
+            recipes = query.fetch(self.PAGE_SIZE)
+        except (db.BadValueError, db.BadRequestError):
+            self.abort(404)
+
+        # Only link to a next page if this one was full
+        next_cursor = None
+        if len(recipes) == self.PAGE_SIZE:
+            next_cursor = query.cursor()
+
+        return self.render('recipes-content.html', {
+            'publicuser': publicuser,
+            'recipes': recipes,
+            'show_owners': not publicuser,
+            'cursor': cursor,
+            'next_cursor': next_cursor
+        }, write_to_stream=False)
+
     def post(self):
         """
         Import a new recipe or list of recipes from BeerXML to the
@@ -88,6 +159,7 @@ class RecipesHandler(BaseHandler):
         """
         user = self.user
         recipesxml = self.request.POST['file'].value
+        count = 0
 
         for recipe in Recipe.new_from_beerxml(recipesxml):
             recipe.owner = user
@@ -101,44 +173,96 @@ class RecipesHandler(BaseHandler):
             action.type = action.TYPE_RECIPE_CREATED
             action.put()
 
+            count += 1
+
+        if count:
+            user.adjust_count('recipe_count', count)
+
         self.redirect('/users/' + user.name + '/recipes')
 
-class RecipeEmbedHandler(BaseHandler):
+def parse_embed_width(value):
     """
-    Handle recipe embeds on other sites. This returns a javascript
-    which is used to render a small widget on another site with information
-    about the recipe and owner.
+    Parse the requested width of an embed widget, falling back to the
+    default width.
 
-        /embed/USERNAME/RECIPE-SLUG
+        >>> parse_embed_width('300')
+        300
+        >>> parse_embed_width('')
+        260
 
     """
-    def get(self, username, recipe_slug):
-        publicuser = UserPrefs.all().filter('name = ', username).get()
+    try:
+        return int(value)
+    except:
+        return 260
 
-        if publicuser:
-            recipe = Recipe.all()\
-                           .filter('owner =', publicuser)\
-                           .filter('slug =', recipe_slug)\
-                           .get()
+
+def render_embeds(handler, embeds):
+    """
+    Render a list of (publicuser, recipe, width) recipe embed widgets and
+    return their HTML in the same order. Widgets are the same for every
+    viewer, so they are rendered without the current user and cached in
+    memcache under their owner, slug, width and edit time.
+    """
+    keys = []
+    for publicuser, recipe, width in embeds:
+        if recipe:
+            keys.append('embed-' + hashlib.md5('%s/%s/%d/%s' % (
+                publicuser.name.encode('utf-8'), recipe.slug.encode('utf-8'),
+                width, recipe.edited)).hexdigest())
         else:
-            recipe = None
+            keys.append(None)
 
-        width = 260
-        try:
-            width = int(self.request.get('width'))
-        except: pass
+    cached = memcache.get_multi([key for key in keys if key])
+
+    rendered = []
+    missing = {}
+    for key, (publicuser, recipe, width) in zip(keys, embeds):
+        html = key and cached.get(key)
 
-        if publicuser and recipe:
-            self.render('recipe-embed.html', {
+        if not html:
+            template = recipe and 'recipe-embed.html' or 'recipe-embed-404.html'
+            html = get_template(template).render({
+                'base_url': handler.request.host_url,
                 'publicuser': publicuser,
                 'recipe': recipe,
                 'width': width,
             })
-        else:
-            self.render('recipe-embed-404.html', {
-                'publicuser': publicuser,
-                'width': width,
-            })
+
+            if key:
+                missing[key] = html
+
+        rendered.append(html)
+
+    if missing:
+        memcache.set_multi(missing, FRAGMENT_CACHE_TIME)
+
+    return rendered
+
+
+class RecipeEmbedHandler(BaseHandler):
+    """
+    Handle recipe embeds on other sites. This renders a small widget with
+    information about the recipe and owner, which is shown in an iframe
+    on another site.
+
+        /embed/USERNAME/RECIPE-SLUG
+
+    """
+    # Time in seconds that anonymous widgets may be cached by browsers
+    # and proxies
+    CACHE_TIME = 5 * 60
+
+    def get(self, username, recipe_slug):
+        publicuser, recipe = RecipePath.resolve(username, recipe_slug)
+
+        width = parse_embed_width(self.request.get('width'))
+
+        if recipe and self.not_modified([recipe.key(), recipe.edited, width],
+                                        recipe.edited, self.CACHE_TIME):
+            return
+
+        self.response.out.write(render_embeds(self, [(publicuser, recipe, width)])[0])
 
 
 class RecipeXmlHandler(BaseHandler):
@@ -150,18 +274,14 @@ class RecipeXmlHandler(BaseHandler):
 
     """
     def get(self, username, recipe_slug):
-        publicuser = UserPrefs.all().filter('name = ', username).get()
-        if not publicuser:
-            self.abort(404)
-
-        recipe = Recipe.all()\
-                       .filter('owner =', publicuser)\
-                       .filter('slug =', recipe_slug)\
-                       .get()
+        publicuser, recipe = RecipePath.resolve(username, recipe_slug)
 
         if not recipe:
             self.abort(404)
 
+        if self.not_modified([recipe.key(), recipe.edited], recipe.edited):
+            return
+
         self.render_xml(recipe.beerxml)
 
 
@@ -175,9 +295,7 @@ class RecipeCloneHandler(BaseHandler):
 
     """
     def post(self, username=None, recipe_slug=None):
-        publicuser = UserPrefs.all()\
-                              .filter('name = ', username)\
-                              .get()
+        publicuser, recipe = RecipePath.resolve(username, recipe_slug)
 
         if not publicuser:
             self.render_json({
@@ -186,11 +304,6 @@ class RecipeCloneHandler(BaseHandler):
             })
             return
 
-        recipe = Recipe.all()\
-                       .filter('owner =', publicuser)\
-                       .filter('slug =', recipe_slug)\
-                       .get()
-
         if not recipe:
             self.render_json({
                 'status': 'error',
@@ -227,12 +340,10 @@ class RecipeCloneHandler(BaseHandler):
 
         new_recipe.slug = generate_usable_slug(new_recipe)
         new_recipe.put()
-        new_recipe.update_grade()
-        new_recipe.put()
+        Recipe.schedule_regrade(new_recipe.key())
 
         # Update recipe ranking for sorting
-        recipe.update_grade()
-        recipe.put()
+        Recipe.add_clone(recipe.key())
 
         action = UserAction()
         action.owner = self.user
@@ -240,6 +351,8 @@ class RecipeCloneHandler(BaseHandler):
         action.object_id = new_recipe.key().id()
         action.put()
 
+        self.user.adjust_count('recipe_count')
+
         return self.render_json({
             'status': 'ok',
             'redirect': new_recipe.url
@@ -257,6 +370,10 @@ class RecipeHandler(BaseHandler):
         /users/USERNAME/recipes/RECIPE-SLUG/VERSION
 
     """
+    # Time in seconds for which anonymous views of historic versions may
+    # be cached by browsers and shared caches, see render_version()
+    VERSION_MAX_AGE = 365 * 24 * 60 * 60
+
     def get(self, username=None, recipe_slug=None, version=None):
         """
         Render the recipe view. If no slug is given then create a new recipe
@@ -269,56 +386,77 @@ class RecipeHandler(BaseHandler):
             recipe.owner = publicuser
             recipe.new = True
             brews = []
+            cloned_from = None
         else:
-            publicuser = UserPrefs.all().filter('name =', username).get()
-
-            if not publicuser:
-                self.abort(404)
-
-            recipe = Recipe.all()\
-                           .filter('owner =', publicuser)\
-                           .filter('slug =', recipe_slug)\
-                           .get()
+            publicuser, recipe = RecipePath.resolve(username, recipe_slug)
 
             if not recipe:
                 self.abort(404)
 
-            brews = recipe.brews.order('-started').fetch(3)
-
             if version:
                 try:
                     version = int(version)
                 except:
                     self.abort(404)
 
-                history = RecipeHistory.get_by_id(version, recipe)
+                if not self.logged_in:
+                    return self.render_version(publicuser, recipe, version)
+
+            # Pages for logged in users show edit and clone controls, so
+            # only anonymous views are served conditionally. Besides the
+            # recipe itself the page shows its recent brews and the owner.
+            if not self.logged_in:
+                user_id = 'user-' + publicuser.user_id
+                recipe_id = 'recipe-' + str(recipe.key().id())
+                versions = get_cache_versions([user_id, recipe_id])
+
+                if self.not_modified([recipe.key(), recipe.edited,
+                                      versions[user_id], versions[recipe_id]]):
+                    return
+
+            # Start all the independent fetches at once and only then wait
+            # for their results
+            brews = recipe.brews.order('-started').run(limit=3)
+
+            cloned_from = None
+            cloned_from_key = Recipe.cloned_from.get_value_for_datastore(recipe)
+            if cloned_from_key:
+                cloned_from = db.get_async(cloned_from_key)
+
+            history = None
+            if version:
+                history = db.get_async(db.Key.from_path('RecipeHistory', version,
+                                                        parent=recipe.key()))
+
+            brews = list(brews)
+
+            if cloned_from:
+                cloned_from = cloned_from.get_result()
+
+            if history:
+                history = history.get_result()
 
                 if not history:
                     self.abort(404)
 
-                recipe.old = True
-                recipe.oldname = history.name
-                recipe.description = history.description
-                recipe.type = history.type
-                recipe.category = history.category
-                recipe.style = history.style
-                recipe.batch_size = history.batch_size
-                recipe.boil_size = history.boil_size
-                recipe.bottling_temp = history.bottling_temp
-                recipe.bottling_pressure = history.bottling_pressure
-                recipe.mash_efficiency = history.mash_efficiency
-                recipe.steep_efficiency = history.steep_efficiency
-                recipe.primary_days = history.primary_days
-                recipe.secondary_days = history.secondary_days
-                recipe.tertiary_days = history.tertiary_days
-                recipe.aging_days = history.aging_days
-                recipe._ingredients = history._ingredients
-
-        cloned_from = None
-        try:
-            cloned_from = recipe.cloned_from
-        except Exception, e:
-            pass
+                recipe = recipe.materialize_version(history)
+                recipe.owner = publicuser
+
+            # Fetch the owners of the brews and parent recipe in one go
+            owners = dict([(user.key(), user) for user in [publicuser, self.user] if user])
+            owner_keys = [brew.owner_key for brew in brews]
+            if cloned_from:
+                owner_keys.append(cloned_from.owner_key)
+
+            missing = list(set([key for key in owner_keys if key and key not in owners]))
+            if missing:
+                for user in db.get(missing):
+                    if user:
+                        owners[user.key()] = user
+
+            for item in brews + (cloned_from and [cloned_from] or []):
+                if item.owner_key in owners:
+                    item.owner = owners[item.owner_key]
 
         self.render('recipe.html', {
             'publicuser': publicuser,
@@ -328,6 +466,57 @@ class RecipeHandler(BaseHandler):
             'now': Date().datetime
         })
 
+    def render_version(self, publicuser, recipe, version):
+        """
+        Render a historic version of a recipe for anonymous users. Versions
+        never change, so the rendered page is cached by the key of the
+        version and may be kept by browsers and shared caches for
+        VERSION_MAX_AGE seconds. Missing versions are a plain 404 without
+        those headers. Unlike the latest version it shows neither the
+        recent brews of the recipe nor the current date in the brew form,
+        since those would make the page change over time.
+        """
+        # Look the version up first, so that the long-lived headers are
+        # only sent for versions which exist
+        history = RecipeHistory.get_by_id(version, parent=recipe)
+
+        if not history:
+            self.abort(404)
+
+        # Links on the page use the owner's name and the recipe slug, which
+        # may change after the version was created
+        validators = [history.key(), publicuser.name, recipe.slug]
+
+        if self.not_modified(validators, max_age=self.VERSION_MAX_AGE):
+            return
+
+        def render_page():
+            version = recipe.materialize_version(history)
+            version.owner = publicuser
+
+            cloned_from = None
+            cloned_from_key = Recipe.cloned_from.get_value_for_datastore(recipe)
+            if cloned_from_key:
+                cloned_from = db.get(cloned_from_key)
+
+            return self.render('recipe.html', {
+                'publicuser': publicuser,
+                'recipe': version,
+                'cloned_from': cloned_from,
+                'brews': [],
+                'now': None
+            }, write_to_stream=False)
+
+        name = 'recipe-version-' + hashlib.md5('-'.join([
+            settings.VERSION, str(history.key()),
+            publicuser.name.encode('utf-8'), recipe.slug.encode('utf-8')
+        ])).hexdigest()
+
+        # Deleting the version, e.g. by history thinning, drops the page
+        self.response.out.write(cached_fragment(name, render_page,
+                                                [history.cache_dependency],
+                                                RecipeHistory.CACHE_TIME))
+
     def post(self, username=None, recipe_slug=None):
         """
         Handle recipe updates. This gets in a JSON object describing a
@@ -356,10 +545,7 @@ class RecipeHandler(BaseHandler):
             recipe.owner = user
             new_recipe = True
         else:
-            recipe = Recipe.all()\
-                           .filter('owner =', user)\
-                           .filter('slug =', recipe_slug)\
-                           .get()
+            recipe = Recipe.get_by_slug(user, recipe_slug)
 
             if not recipe:
                 self.render_json({
@@ -406,6 +592,7 @@ class RecipeHandler(BaseHandler):
         recipe.ingredients = recipe_data['ingredients']
 
         # Update slug
+        old_slug = recipe.slug
         recipe.slug = generate_usable_slug(recipe)
 
         changed = False
@@ -418,21 +605,27 @@ class RecipeHandler(BaseHandler):
             if len(diff[0]) != 0 or \
                len(diff[1]) != 0 or \
                len(diff[2]) != 0:
-                
-                # Save recipe to database
-                key = recipe.put()
+                changed = True
 
-                # Save the historic version to database
-                historic.put()
+        # Save recipe to database and update its grade in the background
+        key = recipe.put()
+        Recipe.schedule_regrade(key)
 
-                changed = True
-        else:
-            # Save recipe to database
-            key = recipe.put()
+        if changed:
+            # Save the historic version to database, along with its entry
+            # on the history page
+            previous = RecipeHistory.latest(recipe)
+            historic.record_changes(previous)
+            historic.store_delta(previous)
+            historic.put()
+
+        # The old URL no longer points to this recipe
+        if old_slug and old_slug != recipe.slug:
+            RecipePath.remove(user.name, old_slug)
+            SlugReservation.release(user.key(), 'Recipe', '', old_slug)
 
-        # Update grade now that we have a key
-        recipe.update_grade()
-        recipe.put()
+        if new_recipe:
+            user.adjust_count('recipe_count')
 
         if not historic or changed:
             action = UserAction()
@@ -467,10 +660,7 @@ class RecipeHandler(BaseHandler):
                 'error': 'User not logged in'
             })
 
-        recipe = Recipe.all()\
-                       .filter('slug = ', recipe_slug)\
-                       .filter('owner =', user)\
-                       .get()
+        recipe = Recipe.get_by_slug(user, recipe_slug)
 
         if recipe:
             # Delete all actions pointing to this recipe
@@ -488,6 +678,8 @@ class RecipeHandler(BaseHandler):
             # Delete the actual recipe itself
             recipe.delete()
 
+            user.adjust_count('recipe_count', -1)
+
             self.render_json({
                 'status': 'ok',
                 'redirect': '/users/%(username)s/recipes' % {
@@ -507,141 +699,97 @@ class RecipeHistoryHandler(BaseHandler):
     a specific recipe. It is invoked via URLs like:
 
         /users/USERNAME/recipes/RECIPE-SLUG/history
+
+    Long histories are paged with a cursor, e.g. ?cursor=CURSOR.
     """
-    IGNORED_KEYS = ('color', 'ibu', 'alcohol')
-    SNIPPET_ITEMS = ('name', 'description')
+    # Number of historic versions to show per page
+    PAGE_SIZE = 20
 
     def get(self, username=None, recipe_slug=None):
         """
-        Render the basic recipe history list for the given recipe.
+        Render the basic recipe history list for the given recipe. The
+        differences of each historic version and whether to show it as a
+        snippet are stored with it, see RecipeHistory.record_changes.
         """
         if not username or not recipe_slug:
             self.abort(404)
 
-        publicuser = UserPrefs.all().filter('name =', username).get()
-        if not publicuser:
-            self.abort(404)
-
-        recipe = Recipe.all()\
-                       .filter('slug = ', recipe_slug)\
-                       .filter('owner =', publicuser)\
-                       .get()
+        publicuser, recipe = RecipePath.resolve(username, recipe_slug)
         if not recipe:
             self.abort(404)
 
-        history = RecipeHistory.all()\
+        cursor = self.request.get('cursor')
+
+        query = RecipeHistory.all()\
                         .ancestor(recipe)\
-                        .order('-created')\
-                        .fetch(20)
+                        .order('-created')
 
-        # The list of entries we'll use to populate the template along with
-        # the current recipe as the first entry
-        entries = [{
-            'recipe': recipe,
-            'edited': recipe.edited,
-            'slug': recipe.slug,
-            'customtag': 'Most Recent',
-            'show_snippet': True
-        }]
-
-        # Check if there is any history to diff with
-        if len(history) > 0:
-            entries[0]['differences'] = self.delete_ignored_keys(recipe.diff(history[0]))
-        else:
-            entries[0]['first'] = True
-
-        # Get a list of differences in the history. Use reduce with a function
-        # that returns the right operand to simply find pairwise differences.
-        differences = []
-        def diff(left, right):
-            differences.append(left.diff(right))
-            return right
-        # Make sure reduce isn't called with no history (throws exception)
-        reduce(diff, history) if len(history) > 0 else None
-
-        # Start going through the history looking at differences to decide how
-        # we plan on displaying the info to the user (using a snippet or not)
-        for i in range(len(differences)):
-            # Make sure this entry has differences before further processing
-            if self.is_empty(differences[i]):
-                continue
+        try:
+            if cursor:
+                query = query.with_cursor(cursor)
 
-            # Set some required properties for the snippet to work
-            history[i].owner = publicuser
-            history[i].slug = recipe.slug + '/history/' + str(history[i].key().id())
+            history = query.fetch(self.PAGE_SIZE)
+        except (db.BadValueError, db.BadRequestError):
+            self.abort(404)
+
+        # Only link to a next page if this one was full
+        next_cursor = None
+        if len(history) == self.PAGE_SIZE:
+            next_cursor = query.cursor()
 
-            # Create the entry
+        # The list of entries we'll use to populate the template along with
+        # the current recipe as the first entry of the first page. Only the
+        # current recipe is diffed here, since it changes with every save.
+        entries = []
+        if not cursor:
             entry = {
-                'recipe': history[i],
-                'differences': self.delete_ignored_keys(differences[i]),
-                'edited': history[i].created,
-                'slug': history[i].slug,
-                'show_snippet': False
+                'recipe': recipe,
+                'edited': recipe.edited,
+                'slug': recipe.slug,
+                'customtag': 'Most Recent',
+                'show_snippet': True
             }
 
-            # Check if the name or description changed and we should show
-            # a snippet
-            for snippetItem in RecipeHistoryHandler.SNIPPET_ITEMS:
-                if snippetItem in differences[i][2]:
-                    entry['show_snippet'] = True
-                    # Make sure the color, ibu, and alcohol were created
-                    if not hasattr(history[i], 'color'):
-                        history[i].update_cache()
-                    break
-
-            # Save the entry
+            if history:
+                entry['differences'] = self.delete_ignored_keys(recipe.diff(history[0]))
+            else:
+                entry['first'] = True
+
             entries.append(entry)
 
-        # Add the final entry only if it's the original recipe, otherwise it
-        # will be a version that should have diffs but we didn't generate any.
-        if len(history) > 0:
-            last = history[-1]
-            delta = timedelta(seconds=1)
-            if recipe.created - delta < last.created < recipe.created + delta:
-                last.owner = publicuser
-                last.slug = recipe.slug + '/history/' + str(last.key().id())
-                if not hasattr(last, 'color'):
-                    last.update_cache()
-                entries.append({
-                    'recipe': last,
-                    'edited': last.created,
-                    'slug': last.slug,
-                    'customtag': 'Original',
-                    'first': True
-                })
+        for version in history:
+            # Set some required properties for the snippet to work
+            version.owner = publicuser
+            version.slug = recipe.slug + '/history/' + str(version.key().id())
+
+            if version.first:
+                # Only show the first version if it's the original recipe,
+                # otherwise it's a version that should have diffs but was
+                # stored without them.
+                delta = timedelta(seconds=1)
+                if recipe.created - delta < version.created < recipe.created + delta:
+                    entries.append({
+                        'recipe': version,
+                        'edited': version.created,
+                        'slug': version.slug,
+                        'customtag': 'Original',
+                        'first': True,
+                        'show_snippet': True
+                    })
+                continue
 
-        # Perform a second pass in reverse to check for large changes that
-        # should show up as a snippet but were missed in the pairwise
-        # checking above.
-        entries[-1]['show_snippet'] = True
-        for i in range(len(entries) - 1, 0, -1):
-            # Check if the snippet is already showing
-            if entries[i]['show_snippet']:
-                last_snippet = entries[i]['recipe']
+            # Skip versions without differences
+            differences = version.changes
+            if not differences or self.is_empty(differences):
                 continue
 
-            # Check if the name, description, color, ibu, or alcohol changed
-            # and we should show a snippet
-            for snippetItem in RecipeHistoryHandler.IGNORED_KEYS:
-                if not hasattr(entries[i]['recipe'], snippetItem):
-                    continue 
-                
-                attr = getattr(entries[i]['recipe'], snippetItem)
-                if type(attr) != int and type(attr) != float:
-                    continue
-
-                # See if the change was more than 10%, then show the
-                # snippet, else show the orb
-                try:
-                    change = float(attr) / getattr(last_snippet, snippetItem)
-                except:
-                    change = 2
-                logging.info(snippetItem)
-                logging.info(change)
-                if change < 0.9 or change > 1.1:
-                    last_snippet = entries[i]['recipe']
-                    entries[i]['show_snippet'] = True
-                    break
+            entries.append({
+                'recipe': version,
+                'differences': differences,
+                'edited': version.created,
+                'slug': version.slug,
+                'show_snippet': version.show_snippet
+            })
 
         # Stop the template from performing another query for the username
         # when it tries to render the recipe
@@ -650,16 +798,17 @@ class RecipeHistoryHandler(BaseHandler):
         self.render('recipe-history.html', {
             'publicuser': publicuser,
             'recipe': recipe,
-            'entries': entries
+            'entries': entries,
+            'cursor': cursor,
+            'next_cursor': next_cursor
         })
 
-
     def delete_ignored_keys(self, differences):
         """
         Delete keys from the difference list we don't want passed to the
         templating system.
         """
-        for key in RecipeHistoryHandler.IGNORED_KEYS:
+        for key in RecipeHistory.IGNORED_KEYS:
             if key in differences[2]:
                 del differences[2][key]
 
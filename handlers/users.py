@@ -1,15 +1,25 @@
 import cgi
 import logging
-import settings
 import webapp2
 
-from google.appengine.api import memcache
 from handlers.base import BaseHandler
-from models.brew import Brew
-from models.recipe import Recipe
+from invalidation import subscribe, USER_CHANGED
+from models.follow import Follow
+from models.timeline import backfill, prune
+from models.recipesummary import RecipeSummary
 from models.useraction import UserAction
+from models.username import Username
 from models.userprefs import UserPrefs
-from util import render, render_json
+from util import render, render_json, bump_cache_version
+from google.appengine.ext import deferred
+
+
+@subscribe(USER_CHANGED)
+def invalidate_users_list(user):
+    """
+    Invalidate the cached public users list when any user changes.
+    """
+    bump_cache_version('users')
 
 
 class UsersHandler(BaseHandler):
@@ -20,22 +30,13 @@ class UsersHandler(BaseHandler):
         /users
 
     """
-    # Time in seconds to cache parts of the page
-    CACHE_TIME = 60 * 60
     def get(self):
         """
-        Render the public users list.
+        Render the public users list. The list is cached by the template
+        until any user changes, so the query only runs on a cache miss.
         """
-        # Try to get users list from memcache instead of datastore
-        users_html = memcache.get('users-content')
-        if not users_html or settings.DEBUG:
-            users_html = self.render('users-content.html', {
-                'users': UserPrefs.all()
-            }, write_to_stream=False)
-            memcache.set('users-content', users_html, self.CACHE_TIME)
-
         self.render('users.html', {
-            'users_content': users_html
+            'users': UserPrefs.all()
         })
 
 
@@ -51,47 +52,29 @@ class UserHandler(BaseHandler):
         """
         Render a user page.
         """
-        publicuser = UserPrefs.all().filter('name =', username).get()
+        publicuser = UserPrefs.get_by_name(username)
 
         if not publicuser:
             self.abort(404)
 
-        recipes = Recipe.all()\
-                        .filter('owner =', publicuser)\
-                        .order('name')\
-                        .run(limit=25)
+        # Start both queries before waiting on the results of either
+        recipes = RecipeSummary.all()\
+                               .filter('owner =', publicuser)\
+                               .order('name')\
+                               .run(limit=25)
 
         actions = UserAction.all()\
                             .filter('owner =', publicuser)\
                             .order('-created')\
-                            .fetch(15)
-
-        object_ids = UserAction.gather_object_ids(actions)
-
-        user_map = {
-            publicuser.key().id(): publicuser
-        }
-
-        for user in UserPrefs.get_by_id(object_ids['users']):
-            user_map[user.key().id()] = user
-
-        recipes = [r for r in recipes]
-        recipe_ids = [recipe.key().id() for recipe in recipes]
-        object_ids['recipes'] = [id for id in object_ids['recipes'] if id not in recipe_ids]
-
-        recipe_map = {}
-
-        for recipe in recipes:
-            recipe.owner = publicuser
-            recipe_map[recipe.key().id()] = recipe
-
-        for recipe in Recipe.get_by_id(object_ids['recipes']):
-            recipe_map[recipe.key().id()] = recipe
+                            .run(limit=15)
 
-        brew_map = {}
+        recipes = list(recipes)
+        actions = list(actions)
 
-        for brew in Brew.get_by_id(object_ids['brews']):
-            brew_map[brew.key().id()] = brew
+        # Load everything the actions refer to
+        user_map, recipe_map, brew_map = UserAction.resolve(actions,
+                                                            users=[publicuser],
+                                                            recipes=recipes)
 
         self.render('user.html', {
             'publicuser': publicuser,
@@ -122,7 +105,7 @@ class UserFollowHandler(BaseHandler):
         Follow the given user.
         """
         user = self.user
-        publicuser = UserPrefs.all().filter('name =', username).get()
+        publicuser = UserPrefs.get_by_name(username)
 
         if not user or not publicuser:
             return self.render_json({
@@ -131,13 +114,18 @@ class UserFollowHandler(BaseHandler):
             })
 
         if action == 'post':
-            if publicuser.user_id in user.following:
+            if not Follow.add(user, publicuser):
                 return self.render_json({
                     'status': 'error',
                     'error': 'Already following user'
                 })
 
-            user.following.append(publicuser.user_id)
+            # Follows only in the legacy following list were already
+            # counted, they just had no edge until now
+            counted = publicuser.user_id in user.following
+
+            if not counted:
+                user.following.append(publicuser.user_id)
 
             existing = UserAction.all()\
                                  .filter('owner =', user)\
@@ -152,13 +140,18 @@ class UserFollowHandler(BaseHandler):
                 user_action.object_id = publicuser.key().id()
                 user_action.put()
         else:
-            if publicuser.user_id not in user.following:
+            # Follows made before the follow graph existed are only in the
+            # legacy following list until the follow-graph migration ran
+            removed = Follow.remove(user, publicuser)
+
+            if not removed and publicuser.user_id not in user.following:
                 return self.render_json({
                     'status': 'error',
                     'error': 'User not being followed'
                 })
 
-            user.following.remove(publicuser.user_id)
+            if publicuser.user_id in user.following:
+                user.following.remove(publicuser.user_id)
 
             existing = UserAction.all()\
                                  .filter('owner =', user)\
@@ -172,6 +165,19 @@ class UserFollowHandler(BaseHandler):
         # Save updated following list
         user.put()
 
+        # Show the followed user's earlier actions on the dashboard, or
+        # stop showing them after unfollowing
+        if action == 'post':
+            deferred.defer(backfill, user.key(), publicuser.key())
+        else:
+            deferred.defer(prune, user.key(), publicuser.key())
+
+        if action == 'post':
+            if not counted:
+                publicuser.adjust_count('follower_count')
+        else:
+            publicuser.adjust_count('follower_count', -1)
+
         self.render_json({
             'status': 'ok'
         })
@@ -207,18 +213,13 @@ class UsernameCheckHandler(BaseHandler):
             self.abort(404)
 
         username = cgi.escape(self.request.get('username'))
-        count = 0
-
-        # Does an existing user have that username?
-        if not user.name == username:
-            count = UserPrefs.all().filter('name =', username).count()
 
-        # Is the name too short or one of the disallowed names?
-        if not username or len(username) < 4 \
-                or username in settings.RESERVED_USERNAMES:
-            count = 1
+        # Is the name long enough and either the user's own name or not
+        # taken by anyone else or disallowed? See Username.available
+        available = len(username) >= 4 and \
+                    (user.name == username or Username.available(username))
 
         self.render_json({
             'username': username,
-            'available': count == 0
+            'available': available
         })
@@ -0,0 +1,95 @@
+"""
+Identity Map
+============
+A request-scoped map of loaded entities, so that each entity is fetched
+at most once per request no matter how many handlers, templates and
+filters look it up. Entities are stored by key and by any other lookup
+used to find them, e.g. a username or a recipe slug:
+
+    user = identity.lookup(('UserPrefs', 'name', name),
+        lambda: UserPrefs.all().filter('name =', name).get())
+
+BaseHandler.dispatch starts a new map for each request and clears it
+when the request is done. Outside of a request, e.g. in deferred tasks,
+no map is active and every lookup goes straight to the datastore.
+"""
+
+import threading
+
+from google.appengine.ext import db
+
+# Requests may be served concurrently, so each thread gets its own map
+_local = threading.local()
+
+
+def start():
+    """
+    Start a new, empty identity map for the current request.
+    """
+    _local.entities = {}
+
+
+def clear():
+    """
+    Drop the identity map of the current request.
+    """
+    _local.entities = None
+
+
+def active():
+    """
+    Return whether an identity map is active for the current request.
+    """
+    return getattr(_local, 'entities', None) is not None
+
+
+def add(entity, alias=None):
+    """
+    Add a loaded entity to the identity map by its key and by an optional
+    alias, which is any hashable value identifying the entity.
+    """
+    if entity is not None and active():
+        _local.entities[entity.key()] = entity
+
+        if alias is not None:
+            _local.entities[alias] = entity
+
+    return entity
+
+
+def lookup(alias, loader):
+    """
+    Get an entity by an alias, calling loader to fetch it if it has not
+    been loaded during this request. Missing entities are not remembered,
+    so an entity created later in the request can still be found.
+    """
+    if active() and alias in _local.entities:
+        return _local.entities[alias]
+
+    return add(loader(), alias)
+
+
+def get_multi(keys):
+    """
+    Get a list of entities by key, fetching all of those not yet loaded
+    during this request with a single batch get. Missing entities are
+    returned as None.
+    """
+    entities = active() and _local.entities or {}
+
+    missing = list(set([key for key in keys if key and key not in entities]))
+    if missing:
+        loaded = dict([(key, add(entity)) for key, entity
+                       in zip(missing, db.get(missing))])
+    else:
+        loaded = {}
+
+    return [key and (entities.get(key) or loaded.get(key)) or None
+            for key in keys]
+
+
+def get(key):
+    """
+    Get a single entity by key, see get_multi.
+    """
+    return get_multi([key])[0]
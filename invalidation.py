@@ -0,0 +1,54 @@
+"""
+Cache Invalidation
+==================
+A small publish / subscribe bus for changes to stored data. Models publish
+a typed event whenever they are written or deleted, and anything that
+caches data derived from them subscribes to the events it depends on,
+usually to bump a cache version (see util.cached_fragment). This keeps
+every cache correct right after a write, no matter which code path made
+the change.
+
+    @subscribe(RECIPE_CHANGED)
+    def invalidate_recipe_list(recipe):
+        bump_cache_version('recipes')
+
+Subscribers are registered when their module is imported, so they should
+live in modules that the main application always imports, e.g. handlers.
+"""
+
+import logging
+
+# Event types, each published with the changed entity
+RECIPE_CHANGED = 'recipe'
+USER_CHANGED = 'user'
+BREW_CHANGED = 'brew'
+
+# Published with the key of the user whose timeline changed
+TIMELINE_CHANGED = 'timeline'
+
+# A mapping of event types to lists of subscribed functions
+subscribers = {}
+
+
+def subscribe(event):
+    """
+    A decorator to call a function with the changed entity every time an
+    event of the given type is published.
+    """
+    def register(func):
+        subscribers.setdefault(event, []).append(func)
+        return func
+
+    return register
+
+
+def publish(event, value):
+    """
+    Publish an event to all of its subscribers. A failing subscriber is
+    logged rather than allowed to break the write that caused the event.
+    """
+    for func in subscribers.get(event, []):
+        try:
+            func(value)
+        except Exception, e:
+            logging.exception(e)
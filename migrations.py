@@ -0,0 +1,438 @@
+"""
+Migrations
+==========
+One-off jobs that backfill or convert existing entities after the data
+model changes. Each migration processes a single batch of entities and
+then defers itself with a query cursor to continue where it left off, so
+that it can run over any number of entities without hitting request
+deadlines. Migrations are started by an admin via:
+
+    /admin/migrate/NAME
+
+Recurring maintenance jobs, like thinning old recipe history, are built
+the same way and are also started on a schedule by cron.yaml.
+
+"""
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import db, deferred
+from models.brew import Brew
+from models.follow import Follow
+from models.ingredients import decode, encode, is_compact
+from models.recipe import Recipe, RecipeHistory
+from models.recipepath import RecipePath
+from models.recipesummary import RecipeSummary
+from models.slugreservation import SlugReservation
+from models.timeline import TimelineChunk
+from models.useraction import UserAction
+from models.username import Username
+from models.userprefs import UserPrefs
+
+# Number of entities to process in each task
+BATCH_SIZE = 50
+
+# Number of recipes whose history is processed in each task, which is
+# smaller since each recipe may have many historic versions
+HISTORY_BATCH_SIZE = 10
+
+# Number of recipes to recalculate in each task, which is larger since
+# their stats are calculated together in one vectorized pass
+STATS_BATCH_SIZE = 500
+
+
+def fetch_batch(query, cursor=None, size=BATCH_SIZE):
+    """
+    Fetch the next batch of entities for a migration, starting at the
+    given cursor if one is passed.
+    """
+    if cursor:
+        query = query.with_cursor(cursor)
+
+    return query.fetch(size)
+
+
+def continue_batch(func, query, batch, size=BATCH_SIZE):
+    """
+    Defer the next run of a migration if the current batch was full,
+    otherwise log that the migration has finished.
+    """
+    if len(batch) == size:
+        deferred.defer(func, query.cursor())
+    else:
+        logging.info('Migration %s finished' % func.__name__)
+
+
+def backfill_user_counts(cursor=None):
+    """
+    Set the cached recipe, brew and follower counts on each user from
+    count queries over the existing data. Follower counts are read from
+    the follow graph, so run the follow-graph migration first.
+    """
+    query = UserPrefs.all()
+    users = fetch_batch(query, cursor)
+
+    for user in users:
+        user.recipe_count = Recipe.all(keys_only=True)\
+                                  .filter('owner =', user)\
+                                  .count(limit=None)
+
+        user.brew_count = Brew.all(keys_only=True)\
+                              .filter('owner =', user)\
+                              .count(limit=None)
+
+        user.follower_count = Follow.all(keys_only=True)\
+                                    .filter('followed =', user)\
+                                    .count(limit=None)
+
+    db.put(users)
+    memcache.delete_multi(['userprefs-' + str(user.user_id) for user in users])
+
+    continue_batch(backfill_user_counts, query, users)
+
+
+def build_timelines(cursor=None):
+    """
+    Seed the timeline of each user without one from the most recent
+    actions of the user and everyone she follows. Run the follow-graph
+    migration first.
+    """
+    query = UserPrefs.all()
+    users = fetch_batch(query, cursor)
+
+    for user in users:
+        if TimelineChunk.all(keys_only=True).ancestor(user).get():
+            continue
+
+        owners = [user.key()]
+        owners.extend(Follow.following(user, limit=1000, keys_only=True)[0])
+
+        actions = []
+        for owner in owners:
+            actions.extend(UserAction.all()\
+                                     .filter('owner =', owner)\
+                                     .order('-created')\
+                                     .fetch(TimelineChunk.CHUNK_SIZE))
+
+        actions.sort(key=lambda action: action.created)
+        actions = actions[-TimelineChunk.CHUNK_SIZE:]
+
+        TimelineChunk(parent=user, **{
+            'actions': [action.key() for action in actions],
+            'times': [action.created for action in actions]
+        }).put()
+
+    continue_batch(build_timelines, query, users)
+
+
+def build_follow_graph(cursor=None):
+    """
+    Create follow graph edges from each user's list of followed user ids.
+    """
+    query = UserPrefs.all()
+    users = fetch_batch(query, cursor)
+
+    edges = []
+    for user in users:
+        for user_id in user.following:
+            followed = UserPrefs.all(keys_only=True)\
+                                .filter('user_id =', user_id)\
+                                .get()
+            if followed:
+                edges.append(Follow(key_name=Follow.key_name_for(user, followed),
+                                    follower=user, followed=followed))
+
+    db.put(edges)
+
+    continue_batch(build_follow_graph, query, users)
+
+
+def build_recipe_paths(cursor=None):
+    """
+    Create the URL path index entry of each recipe.
+    """
+    query = Recipe.all()
+    recipes = Recipe.prefetch_owners(fetch_batch(query, cursor))
+
+    for recipe in recipes:
+        RecipePath.update(recipe)
+
+    continue_batch(build_recipe_paths, query, recipes)
+
+
+def reserve_recipe_slugs(cursor=None):
+    """
+    Reserve the slug of each existing recipe, so that new recipes can never
+    be given the same slug.
+    """
+    query = Recipe.all()
+    recipes = fetch_batch(query, cursor)
+
+    db.put([SlugReservation(key=SlugReservation.key_for(recipe.owner_key,
+                'Recipe', '', recipe.slug))
+            for recipe in recipes if recipe.owner_key and recipe.slug])
+
+    continue_batch(reserve_recipe_slugs, query, recipes)
+
+
+def reserve_brew_slugs(cursor=None):
+    """
+    Reserve the slug of each existing brew, so that new brews of the same
+    recipe can never be given the same slug.
+    """
+    query = Brew.all()
+    brews = fetch_batch(query, cursor)
+
+    db.put([SlugReservation(key=SlugReservation.key_for(brew.owner_key,
+                'Brew', brew.recipe_key.id(), brew.slug))
+            for brew in brews if brew.owner_key and brew.recipe_key and brew.slug])
+
+    continue_batch(reserve_brew_slugs, query, brews)
+
+
+def register_usernames(cursor=None):
+    """
+    Add the name of each existing user to the username registry. Names
+    shared by several users are logged, and only the first is registered.
+    """
+    query = UserPrefs.all()
+    users = fetch_batch(query, cursor)
+
+    for user in users:
+        if not Username.claim(user.name, user.key()):
+            logging.warning('Username %s of user %d is already taken' % (
+                            user.name, user.key().id()))
+
+    continue_batch(register_usernames, query, users)
+
+
+def build_recipe_summaries(cursor=None):
+    """
+    Create the list page summary of each recipe.
+    """
+    query = Recipe.all()
+    recipes = Recipe.prefetch_owners(fetch_batch(query, cursor))
+
+    RecipeSummary.update_all(recipes)
+
+    continue_batch(build_recipe_summaries, query, recipes)
+
+
+def rebuild_recipe_stats(cursor=None):
+    """
+    Store the clone count, brew count and recent brew statistics of each
+    recipe and regrade it from them.
+    """
+    query = Recipe.all()
+    recipes = Recipe.prefetch_owners(fetch_batch(query, cursor))
+
+    for recipe in recipes:
+        recipe.rebuild_stats()
+        recipe.update_grade()
+
+    Recipe.put_unedited(recipes)
+    RecipeSummary.update_all(recipes)
+
+    continue_batch(rebuild_recipe_stats, query, recipes)
+
+
+def recalculate_recipe_stats(cursor=None):
+    """
+    Recalculate the cached color, bitterness, alcohol and calories of each
+    recipe with the batch calculator in recipestats. Run this after
+    changing any of the formulas in RecipeBase.update_cache.
+    """
+    import recipestats
+
+    query = Recipe.all()
+    recipes = fetch_batch(query, cursor, STATS_BATCH_SIZE)
+
+    # Write directly to skip the per-recipe path and cache updates of put()
+    changed = Recipe.prefetch_owners(recipestats.apply(recipes))
+    Recipe.put_unedited(changed)
+    RecipeSummary.update_all(changed)
+
+    continue_batch(recalculate_recipe_stats, query, recipes, STATS_BATCH_SIZE)
+
+
+def recalculate_history_stats(cursor=None):
+    """
+    Recalculate the stored color, bitterness and alcohol of each historic
+    recipe version with the batch calculator in recipestats, and update
+    which versions the history page shows as snippets since that depends
+    on them. Run this together with recipe-calculations.
+    """
+    import recipestats
+
+    query = Recipe.all(keys_only=True)
+    keys = fetch_batch(query, cursor, HISTORY_BATCH_SIZE)
+
+    for key in keys:
+        history = list(RecipeHistory.all()\
+                                    .ancestor(key)\
+                                    .order('-created'))
+
+        # Rebuild the ingredients of versions stored as deltas, then walk
+        # from the oldest version to the newest
+        history.reverse()
+        RecipeHistory.expand(history)
+
+        if not recipestats.apply(history):
+            continue
+
+        previous = None
+        for version in history:
+            version.record_changes(previous)
+            previous = version
+
+        db.put(history)
+
+    continue_batch(recalculate_history_stats, query, keys, HISTORY_BATCH_SIZE)
+
+
+def compact_entities(entities):
+    """
+    Convert the stored ingredients and mash of recipes or historic
+    versions from plain JSON to the compact format, returning the
+    entities that changed.
+    """
+    changed = []
+
+    for entity in entities:
+        converted = False
+
+        for name in ['_ingredients', '_mash']:
+            value = getattr(entity, name)
+
+            # Historic versions stored as deltas have no full ingredients
+            if value is not None and not is_compact(value):
+                setattr(entity, name, encode(decode(value)))
+                converted = True
+
+        if converted:
+            changed.append(entity)
+
+    return changed
+
+
+def compact_recipes(cursor=None):
+    """
+    Store the ingredients and mash of each recipe in the compact format.
+    """
+    query = Recipe.all()
+    recipes = fetch_batch(query, cursor)
+
+    # Write directly to skip the per-recipe path and cache updates of
+    # put(), keeping the time each recipe was last edited
+    Recipe.put_unedited(compact_entities(recipes))
+
+    continue_batch(compact_recipes, query, recipes)
+
+
+def compact_recipe_history(cursor=None):
+    """
+    Store the ingredients and mash of each historic recipe version in the
+    compact format.
+    """
+    query = RecipeHistory.all()
+    history = fetch_batch(query, cursor)
+
+    db.put(compact_entities(history))
+
+    continue_batch(compact_recipe_history, query, history)
+
+
+def record_history_changes(cursor=None):
+    """
+    Store the differences from the previous version and the snippet
+    decision of each historic recipe version, see
+    RecipeHistory.record_changes.
+    """
+    query = Recipe.all(keys_only=True)
+    keys = fetch_batch(query, cursor, HISTORY_BATCH_SIZE)
+
+    for key in keys:
+        history = list(RecipeHistory.all()\
+                                    .ancestor(key)\
+                                    .order('-created'))
+
+        # Walk from the oldest version to the newest
+        history.reverse()
+
+        previous = None
+        for version in history:
+            version.record_changes(previous)
+            previous = version
+
+        db.put(history)
+
+    continue_batch(record_history_changes, query, keys, HISTORY_BATCH_SIZE)
+
+
+def build_history_deltas(cursor=None):
+    """
+    Number the historic versions of each recipe and store them as
+    keyframes and deltas, see RecipeHistory.store_delta.
+    """
+    query = Recipe.all(keys_only=True)
+    keys = fetch_batch(query, cursor, HISTORY_BATCH_SIZE)
+
+    for key in keys:
+        history = list(RecipeHistory.all()\
+                                    .ancestor(key)\
+                                    .order('-created'))
+
+        # Load the full ingredients of every version before any of them
+        # are converted, then walk from the oldest version to the newest
+        history.reverse()
+        RecipeHistory.expand(history)
+
+        previous = None
+        for version in history:
+            version.store_delta(previous)
+            previous = version
+
+        db.put(history)
+
+    continue_batch(build_history_deltas, query, keys, HISTORY_BATCH_SIZE)
+
+
+def thin_recipe_history(cursor=None):
+    """
+    Delete old historic recipe versions which are not kept by the history
+    retention policy, see RecipeHistory.thin and
+    settings.HISTORY_RETENTION. This runs periodically, see cron.yaml.
+    """
+    query = Recipe.all(keys_only=True)
+    keys = fetch_batch(query, cursor, HISTORY_BATCH_SIZE)
+
+    for key in keys:
+        removed = RecipeHistory.thin(key)
+
+        if removed:
+            logging.info('Removed %d historic versions of recipe %d' % (
+                         removed, key.id()))
+
+    continue_batch(thin_recipe_history, query, keys, HISTORY_BATCH_SIZE)
+
+
+# A mapping of migration names to functions, used by the admin handler
+MIGRATIONS = {
+    'user-counts': backfill_user_counts,
+    'timelines': build_timelines,
+    'follow-graph': build_follow_graph,
+    'recipe-paths': build_recipe_paths,
+    'recipe-slugs': reserve_recipe_slugs,
+    'brew-slugs': reserve_brew_slugs,
+    'usernames': register_usernames,
+    'recipe-summaries': build_recipe_summaries,
+    'recipe-stats': rebuild_recipe_stats,
+    'recipe-calculations': recalculate_recipe_stats,
+    'history-calculations': recalculate_history_stats,
+    'compact-recipes': compact_recipes,
+    'compact-history': compact_recipe_history,
+    'history-changes': record_history_changes,
+    'history-deltas': build_history_deltas,
+    'history-thinning': thin_recipe_history
+}
@@ -1,6 +1,7 @@
 import logging
 
 from google.appengine.ext import db
+from invalidation import publish, BREW_CHANGED
 from models.recipe import Recipe
 from models.userprefs import UserPrefs
 
@@ -34,6 +35,24 @@ class Brew(db.Model):
     def owner_key(self):
         return Brew.owner.get_value_for_datastore(self)
 
+    def put(self, *args):
+        """
+        Save this brew, invalidating any caches which show it.
+        """
+        key = super(Brew, self).put(*args)
+
+        publish(BREW_CHANGED, self)
+
+        return key
+
+    def delete(self, *args):
+        """
+        Delete this brew, invalidating any caches which show it.
+        """
+        super(Brew, self).delete(*args)
+
+        publish(BREW_CHANGED, self)
+
     @property
     def recipe_key(self):
         return Brew.recipe.get_value_for_datastore(self)
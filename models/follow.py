@@ -0,0 +1,114 @@
+from google.appengine.ext import db
+from models.userprefs import UserPrefs
+
+
+class Follow(db.Model):
+    """
+    An edge in the follow graph, stating that one user follows another.
+    A single entity stores both directions: querying on `follower` gives
+    the users someone follows and querying on `followed` gives her
+    followers. The key name is built from both user ids so that an edge
+    can be checked, created or removed with a single get or put.
+    """
+    follower = db.ReferenceProperty(UserPrefs, collection_name='following_edges')
+    followed = db.ReferenceProperty(UserPrefs, collection_name='follower_edges')
+
+    # When the user was followed
+    created = db.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def key_name_for(follower, followed):
+        """
+        Get the key name of the edge between two users or user keys.
+        """
+        def user_id(user):
+            if isinstance(user, db.Model):
+                return user.key().id()
+            return user.id()
+
+        return '%d-%d' % (user_id(follower), user_id(followed))
+
+    @staticmethod
+    def exists(follower, followed):
+        """
+        Return whether follower is following followed.
+        """
+        return Follow.get_by_key_name(Follow.key_name_for(follower, followed)) is not None
+
+    @staticmethod
+    def add(follower, followed):
+        """
+        Add an edge to the follow graph, returning False if it already
+        existed.
+        """
+        key_name = Follow.key_name_for(follower, followed)
+
+        def txn():
+            if Follow.get_by_key_name(key_name):
+                return False
+
+            Follow(key_name=key_name, follower=follower, followed=followed).put()
+            return True
+
+        return db.run_in_transaction(txn)
+
+    @staticmethod
+    def remove(follower, followed):
+        """
+        Remove an edge from the follow graph, returning False if it did not
+        exist.
+        """
+        key = db.Key.from_path('Follow', Follow.key_name_for(follower, followed))
+
+        def txn():
+            if not db.get(key):
+                return False
+
+            db.delete(key)
+            return True
+
+        return db.run_in_transaction(txn)
+
+    @staticmethod
+    def followers(user, limit=100, cursor=None, keys_only=False):
+        """
+        Get a page of the users following a user, newest first, along with
+        a cursor for the next page. The users are loaded with a single
+        batch get, or only their keys are returned if keys_only is set.
+        """
+        return Follow._page(Follow.followed, Follow.follower, user,
+                            limit, cursor, keys_only)
+
+    @staticmethod
+    def following(user, limit=100, cursor=None, keys_only=False):
+        """
+        Get a page of the users that a user follows, newest first, along
+        with a cursor for the next page. The users are loaded with a single
+        batch get, or only their keys are returned if keys_only is set.
+        """
+        return Follow._page(Follow.follower, Follow.followed, user,
+                            limit, cursor, keys_only)
+
+    @staticmethod
+    def _page(match, other, user, limit, cursor, keys_only):
+        """
+        Query one direction of the follow graph, see followers().
+        """
+        query = Follow.all()\
+                      .filter(match.name + ' =', user)\
+                      .order('-created')
+
+        if cursor:
+            query = query.with_cursor(cursor)
+
+        edges = query.fetch(limit)
+        keys = [other.get_value_for_datastore(edge) for edge in edges]
+
+        next_cursor = None
+        if len(edges) == limit:
+            next_cursor = query.cursor()
+
+        if keys_only:
+            return keys, next_cursor
+
+        return [user for user in db.get(keys) if user], next_cursor
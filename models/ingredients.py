@@ -0,0 +1,454 @@
+"""
+Typed Ingredients
+=================
+Slot-based classes for the ingredients and mash steps stored as JSON on
+recipes. Each is built once when a recipe's ingredients are decoded, so
+values that every consumer needs, like hop times in minutes or whether
+a fermentable is added late, are normalized a single time at parse time
+instead of on every use.
+
+The objects still behave like the dicts they were parsed from, so
+templates and code using ingredient['description'] keep working, and
+they serialize back to exactly the same JSON.
+
+Ingredients and mashes are stored in a compact format: a header byte
+giving the format version, then base64 of zlib compressed JSON in which
+known field names are replaced by short codes. Plain JSON, as written
+before this format existed, is still read transparently.
+
+    >>> mash = {'type': 'singleinfusion', 'steps': [{'name': 'Rest', 'duration': 60}]}
+    >>> data = encode(mash)
+    >>> data[0] == FORMAT_COMPACT
+    True
+    >>> decode(data) == decode(json.dumps(mash)) == mash
+    True
+
+    >>> hop = Spice({'description': 'Cascade', 'aa': 5.5, 'oz': 1.0, 'use': 'boil', 'time': '1 hr', 'form': 'pellet'})
+    >>> hop.description == hop['description'] == 'Cascade'
+    True
+    >>> hop.minutes, hop.boil_time
+    (60.0, 1)
+    >>> 'late' in Fermentable({'description': 'Pale malt'})
+    False
+    >>> Fermentable({'late': 'y'}).is_late
+    True
+
+"""
+
+import base64
+import json
+import time
+import zlib
+
+from util import time_to_min
+
+# Values of a fermentable's free-form late field which mean it is added
+# after the boil, see static/scripts/main/recipe.coffee
+LATE_VALUES = ['y', 'yes', 'x']
+
+
+class Item(object):
+    """
+    A single ingredient or mash step. Stored fields are kept in slots,
+    which are only set when the field is present in the stored data, and
+    any unknown fields are kept aside so they survive a round trip.
+    """
+    __slots__ = ('_extra',)
+
+    # Names of the stored fields, in the order they are serialized
+    FIELDS = ()
+
+    def __init__(self, data=None):
+        self._extra = None
+
+        for name, value in (data or {}).items():
+            if name in self.FIELDS:
+                setattr(self, name, value)
+            else:
+                self._set_extra(name, value)
+
+        self.normalize()
+
+    def normalize(self):
+        """
+        Compute derived values from the stored fields.
+        """
+        pass
+
+    def __getitem__(self, name):
+        if name in self.FIELDS:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                raise KeyError(name)
+
+        if self._extra is None:
+            raise KeyError(name)
+
+        return self._extra[name]
+
+    def __setitem__(self, name, value):
+        if name in self.FIELDS:
+            setattr(self, name, value)
+            self.normalize()
+        else:
+            self._set_extra(name, value)
+
+    def _set_extra(self, name, value):
+        if self._extra is None:
+            self._extra = {}
+
+        self._extra[name] = value
+
+    def __contains__(self, name):
+        if name in self.FIELDS:
+            return hasattr(self, name)
+
+        return self._extra is not None and name in self._extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, Item):
+            other = other.to_dict()
+
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def keys(self):
+        keys = [name for name in self.FIELDS if hasattr(self, name)]
+
+        if self._extra:
+            keys += self._extra.keys()
+
+        return keys
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        """
+        Get the stored fields as a plain dict, e.g. for serializing.
+        """
+        return dict(self.items())
+
+
+class Fermentable(Item):
+    """
+    A malt, extract or sugar. `is_late` is True if it is added after the
+    boil.
+    """
+    FIELDS = ('description', 'weight', 'late', 'ppg', 'color')
+    __slots__ = FIELDS + ('is_late',)
+
+    def normalize(self):
+        self.is_late = self.get('late') in LATE_VALUES
+
+
+class Spice(Item):
+    """
+    A hop or other spice. `minutes` is the time in minutes, or None if it
+    cannot be parsed, and `boil_time` holds the digits of the time as an
+    integer like static/scripts/main/recipe.coffee uses for bitterness, or
+    None if there are none.
+    """
+    FIELDS = ('description', 'oz', 'aa', 'use', 'time', 'form')
+    __slots__ = FIELDS + ('minutes', 'boil_time')
+
+    def normalize(self):
+        try:
+            self.minutes = time_to_min(self.get('time', 0))
+        except (TypeError, ValueError):
+            self.minutes = None
+
+        digits = ''.join([char for char in unicode(self.get('time', '')) if char.isdigit()])
+        if digits:
+            self.boil_time = int(digits)
+        else:
+            self.boil_time = None
+
+
+# Hops are stored with the other spices
+Hop = Spice
+
+
+class Yeast(Item):
+    """
+    A yeast strain.
+    """
+    FIELDS = ('description', 'type', 'form', 'attenuation')
+    __slots__ = FIELDS
+
+
+class MashStep(Item):
+    """
+    A single mash step.
+    """
+    FIELDS = ('name', 'duration', 'temperature')
+    __slots__ = FIELDS
+
+
+# Ingredient classes by the key they are stored under
+INGREDIENT_TYPES = {
+    'fermentables': Fermentable,
+    'spices': Spice,
+    'yeast': Yeast
+}
+
+
+# Format header of the compact encoding. Plain JSON always starts with '{'
+FORMAT_COMPACT = '\x01'
+
+# Short codes for known field names in the compact encoding. Codes must
+# never change once data has been written with them, only be added.
+KEY_CODES = {
+    'fermentables': 'F',
+    'spices': 'S',
+    'yeast': 'Y',
+    'description': 'd',
+    'weight': 'w',
+    'late': 'l',
+    'ppg': 'p',
+    'color': 'c',
+    'oz': 'o',
+    'aa': 'a',
+    'use': 'u',
+    'time': 't',
+    'form': 'f',
+    'type': 'y',
+    'attenuation': 'n',
+    'steps': 's',
+    'name': 'm',
+    'duration': 'r',
+    'temperature': 'e',
+    'water_ratio': 'q',
+    'mashout': 'h',
+    'sparge': 'g'
+}
+
+KEY_NAMES = dict([(code, name) for name, code in KEY_CODES.items()])
+
+# Prefix of other keys which would be mistaken for a code when decoding
+KEY_ESCAPE = '~'
+
+
+def _compact(value):
+    """
+    Get a copy of a value with known keys replaced by their short codes.
+    """
+    if isinstance(value, Item):
+        value = value.to_dict()
+
+    if isinstance(value, dict):
+        compacted = {}
+
+        for key, item in value.items():
+            if key in KEY_CODES:
+                key = KEY_CODES[key]
+            elif key in KEY_NAMES or key.startswith(KEY_ESCAPE):
+                key = KEY_ESCAPE + key
+
+            compacted[key] = _compact(item)
+
+        return compacted
+
+    if isinstance(value, list):
+        return [_compact(item) for item in value]
+
+    return value
+
+
+def _expand(compacted):
+    """
+    Restore the field names of a single decoded dict, used as a JSON
+    object hook so that each dict is only visited once.
+    """
+    value = {}
+
+    for key, item in compacted.items():
+        if key in KEY_NAMES:
+            key = KEY_NAMES[key]
+        elif key.startswith(KEY_ESCAPE):
+            key = key[len(KEY_ESCAPE):]
+
+        value[key] = item
+
+    return value
+
+
+def encode(value):
+    """
+    Serialize ingredients or a mash, which may hold typed objects, to the
+    compact format.
+    """
+    data = json.dumps(_compact(value), separators=(',', ':'))
+
+    return FORMAT_COMPACT + base64.b64encode(zlib.compress(data, 9))
+
+
+def decode(data):
+    """
+    Deserialize ingredients or a mash stored in either the compact format
+    or as plain JSON.
+    """
+    if data.startswith(FORMAT_COMPACT):
+        data = zlib.decompress(base64.b64decode(data[len(FORMAT_COMPACT):]))
+        return json.loads(data, object_hook=_expand)
+
+    return json.loads(data)
+
+
+def is_compact(data):
+    """
+    Return whether stored ingredients or a mash use the compact format.
+    """
+    return data.startswith(FORMAT_COMPACT)
+
+
+def benchmark(values, runs=100):
+    """
+    Compare plain JSON to the compact format for a list of stored
+    ingredient or mash values, e.g. from the remote API shell:
+
+        benchmark([r._ingredients for r in Recipe.all().fetch(100)])
+
+    Returns the total size in bytes of all values and the time in seconds
+    to decode them all once, in each format.
+    """
+    plain = [json.dumps(decode(value)) for value in values]
+    compact = [encode(decode(value)) for value in values]
+
+    results = {}
+    for name, encoded in [('json', plain), ('compact', compact)]:
+        start = time.time()
+        for i in range(runs):
+            for value in encoded:
+                decode(value)
+
+        results[name] = {
+            'bytes': sum([len(value) for value in encoded]),
+            'decode_seconds': (time.time() - start) / runs
+        }
+
+    return results
+
+
+def _plain(value):
+    """
+    Get a list of ingredients as plain values, e.g. for comparing them.
+    """
+    if isinstance(value, list):
+        return [isinstance(item, Item) and item.to_dict() or item for item in value]
+
+    return value
+
+
+def delta(old, new):
+    """
+    Get the changes between two versions of a recipe's ingredients, such
+    that apply_delta(old, delta(old, new)) == new. Each ingredient list
+    that changed is stored with unchanged ingredients replaced by their
+    index in the old list, so the size of a delta is proportional to what
+    changed rather than to the size of the recipe.
+
+        >>> old = {'yeast': [{'description': 'US-05'}], 'spices': [{'description': 'Cascade'}, {'description': 'Citra'}]}
+        >>> new = {'yeast': [{'description': 'US-05'}], 'spices': [{'description': 'Citra'}, {'description': 'Mosaic'}]}
+        >>> delta(old, new)
+        {'lists': {'spices': [1, {'description': 'Mosaic'}]}}
+        >>> apply_delta(old, delta(old, new)) == new
+        True
+        >>> apply_delta({'yeast': [{}]}, delta({'yeast': [{}]}, {'yeast': [{}, {}]}))
+        {'yeast': [{}, {}]}
+
+    """
+    changes = {}
+
+    for key in new:
+        old_value = _plain(old.get(key))
+        new_value = _plain(new[key])
+
+        if key in old and old_value == new_value:
+            continue
+
+        if isinstance(old_value, list) and isinstance(new_value, list):
+            unused = range(len(old_value))
+            items = []
+
+            for item in new_value:
+                for index in unused:
+                    if old_value[index] == item:
+                        unused.remove(index)
+                        item = index
+                        break
+
+                items.append(item)
+
+            changes.setdefault('lists', {})[key] = items
+        else:
+            changes.setdefault('values', {})[key] = new_value
+
+    removed = [key for key in old if key not in new]
+    if removed:
+        changes['removed'] = removed
+
+    return changes
+
+
+def apply_delta(old, changes):
+    """
+    Rebuild a version of a recipe's ingredients from the previous version
+    and the changes between them, see delta(). Returns plain values.
+    """
+    new = dict([(key, _plain(value)) for key, value in old.items()])
+
+    for key, items in changes.get('lists', {}).items():
+        new[key] = [new[key][item] if isinstance(item, int) else item
+                    for item in items]
+
+    new.update(changes.get('values', {}))
+
+    for key in changes.get('removed', []):
+        del new[key]
+
+    return new
+
+
+def parse_ingredients(data):
+    """
+    Get a recipe ingredients dict, either decoded from JSON or as sent by
+    a client, with each ingredient list turned into typed objects.
+    """
+    ingredients = dict(data)
+
+    for name, cls in INGREDIENT_TYPES.items():
+        if name in ingredients:
+            ingredients[name] = [cls(item) for item in ingredients[name]]
+
+    return ingredients
+
+
+def parse_mash(data):
+    """
+    Get a recipe mash dict with its steps turned into typed objects.
+    """
+    mash = dict(data)
+
+    if 'steps' in mash:
+        mash['steps'] = [MashStep(step) for step in mash['steps']]
+
+    return mash
@@ -1,12 +1,22 @@
+import identity
 import json
 import logging
 import math
 import re
+import settings
+import tasks
 import xml.etree.ElementTree as et
 
+from datetime import datetime
+from google.appengine.api import datastore
+from google.appengine.api import memcache
 from google.appengine.ext import db
+from models.ingredients import apply_delta, decode, delta, encode, \
+                               parse_ingredients, parse_mash
+from models.slugreservation import SlugReservation
 from models.userprefs import UserPrefs
-from util import time_to_min, xmlescape, GAL_TO_LITERS, LB_TO_KG
+from invalidation import publish, RECIPE_CHANGED
+from util import xmlescape, bump_cache_version, GAL_TO_LITERS, LB_TO_KG
 
 
 class RecipeBase(db.Model):
@@ -14,9 +24,10 @@ class RecipeBase(db.Model):
     A data model to store information about a single recipe. This stores
     things like the owner, creation date, name, size, ingredients, etc.
 
-    The ingredients themselves are stored as a serialized JSON string.
-    A property handler converts this to Python objects behind the
-    scenes to make working with the recipe ingredients easier.
+    The ingredients themselves are stored as a serialized string, see
+    models.ingredients for the format. A property handler converts this
+    to Python objects behind the scenes to make working with the recipe
+    ingredients easier.
 
     This class is a common base for both the latest version of recipe
     data and hitorical versions, which are stored in a separate table.
@@ -85,10 +96,12 @@ class RecipeBase(db.Model):
     @property
     def mash(self):
         """
-        Get deserialized object from the recipe mash JSON.
+        Get the recipe mash, with its steps parsed into MashStep objects.
+        This is decoded once and cached until the mash JSON changes.
         """
-        if not hasattr(self, '_mash_decoded'):
-            self._mash_decoded = json.loads(self._mash)
+        if getattr(self, '_mash_source', None) is not self._mash:
+            self._mash_decoded = parse_mash(decode(self._mash))
+            self._mash_source = self._mash
 
         return self._mash_decoded
 
@@ -97,16 +110,20 @@ class RecipeBase(db.Model):
         """
         Automatically serialize a mash object to JSON.
         """
-        self._mash = json.dumps(value)
-        self._mash_decoded = value
+        self._mash = encode(value)
+        self._mash_decoded = parse_mash(value)
+        self._mash_source = self._mash
 
     @property
     def ingredients(self):
         """
-        Get a deserialized object from the recipe ingredient JSON.
+        Get the recipe ingredients, with each ingredient parsed into a
+        Fermentable, Spice or Yeast object. This is decoded once and cached
+        until the ingredient JSON changes.
         """
-        if not hasattr(self, '_ingredients_decoded'):
-            self._ingredients_decoded = json.loads(self._ingredients)
+        if getattr(self, '_ingredients_source', None) is not self._ingredients:
+            self._ingredients_decoded = parse_ingredients(decode(self._ingredients))
+            self._ingredients_source = self._ingredients
 
         return self._ingredients_decoded
 
@@ -115,8 +132,13 @@ class RecipeBase(db.Model):
         """
         Automatically serialize an ingredients object to JSON.
         """
-        self._ingredients = json.dumps(value)
-        self._ingredients_decoded = value
+        self._ingredients = encode(value)
+        self._ingredients_decoded = parse_ingredients(value)
+        self._ingredients_source = self._ingredients
+
+    @property
+    def owner_name(self):
+        return self.owner.name
 
     @property
     def style_display(self):
@@ -150,23 +172,20 @@ class RecipeBase(db.Model):
             xml += '<AMOUNT>' + xmlescape(hop['oz'] / 35.275) + '</AMOUNT>'
             xml += '<AMOUNT_IS_WEIGHT>TRUE</AMOUNT_IS_WEIGHT>'
             xml += '<USE>' + xmlescape(hop['use'].capitalize()) + '</USE>'
-            xml += '<TIME>' + xmlescape(int(time_to_min(hop['time']))) + '</TIME>'
+            xml += '<TIME>' + xmlescape(int(hop.minutes)) + '</TIME>'
             xml += '<FORM>' + xmlescape(hop['form'].capitalize()) + '</FORM>'
             xml += '</HOP>'
         xml += '</HOPS>'
 
         xml += '<FERMENTABLES>'
         for fermentable in self.ingredients['fermentables']:
-            if 'late' not in fermentable:
-                fermentable['late'] = False
-
             xml += '<FERMENTABLE>'
             xml += '<VERSION>1</VERSION>'
             xml += '<NAME>' + xmlescape(fermentable['description']) + '</NAME>'
             xml += '<AMOUNT>' + xmlescape(fermentable['weight'] * LB_TO_KG) + '</AMOUNT>'
             xml += '<YIELD>' + xmlescape(fermentable['ppg'] / 46.214 / 0.01) + '</YIELD>'
             xml += '<COLOR>' + xmlescape(fermentable['color']) + '</COLOR>'
-            xml += '<ADD_AFTER_BOIL>' + (fermentable['late'] and 'TRUE' or 'FALSE') + '</ADD_AFTER_BOIL>'
+            xml += '<ADD_AFTER_BOIL>' + (fermentable.is_late and 'TRUE' or 'FALSE') + '</ADD_AFTER_BOIL>'
             xml += '</FERMENTABLE>'
         xml += '</FERMENTABLES>'
 
@@ -178,7 +197,7 @@ class RecipeBase(db.Model):
             xml += '<AMOUNT>' + xmlescape(misc['oz'] / 35.275) + '</AMOUNT>'
             xml += '<AMOUNT_IS_WEIGHT>TRUE</AMOUNT_IS_WEIGHT>'
             xml += '<USE>' + xmlescape(misc['use'].capitalize()) + '</USE>'
-            xml += '<TIME>' + xmlescape(int(time_to_min(misc['time']))) + '</TIME>'
+            xml += '<TIME>' + xmlescape(int(misc.minutes)) + '</TIME>'
             xml += '</MISC>'
         xml += '</MISCS>'
 
@@ -204,9 +223,11 @@ class RecipeBase(db.Model):
         should not be modified without also modifying that file!
 
             >>> r = Recipe()
-            >>> r.ingredients['fermentables'] += [{'weight': 6.0, 'description': 'Extra pale liquid extract', 'late': '', 'ppg': 37, 'color': 2}, {'weight': 0.5, 'description': 'Caramel 40L', 'late': '', 'ppg': 34, 'color': 40}]
-            >>> r.ingredients['spices'] += [{'use': 'boil', 'time': '60', 'oz': 1.0, 'description': '', 'form': 'pellet', 'aa': 4.0}, {'use': 'boil', 'time': '15', 'oz': 0.5, 'description': '', 'form': 'pellet', 'aa': 3.5}]
-            >>> r.ingredients['yeast'].append({'description': '', 'form': 'pellet', 'attenuation': 80})
+            >>> r.ingredients = {
+            ...     'fermentables': [{'weight': 6.0, 'description': 'Extra pale liquid extract', 'late': '', 'ppg': 37, 'color': 2}, {'weight': 0.5, 'description': 'Caramel 40L', 'late': '', 'ppg': 34, 'color': 40}],
+            ...     'spices': [{'use': 'boil', 'time': '60', 'oz': 1.0, 'description': '', 'form': 'pellet', 'aa': 4.0}, {'use': 'boil', 'time': '15', 'oz': 0.5, 'description': '', 'form': 'pellet', 'aa': 3.5}],
+            ...     'yeast': [{'description': '', 'form': 'pellet', 'attenuation': 80}]
+            ... }
             >>> r.update_cache()
             >>> r.alcohol
             4.9
@@ -255,7 +276,7 @@ class RecipeBase(db.Model):
             elif addition == 'mash':
                 gravity *= (self.mash_efficiency / 100.0)
 
-            if 'late' not in fermentable or fermentable['late'] not in ['y', 'yes', 'x']:
+            if not fermentable.is_late:
                 early_gu += gravity
 
             gu += gravity
@@ -290,7 +311,10 @@ class RecipeBase(db.Model):
             if hop['form'] == 'pellet':
                 utilization_factor = 1.15
 
-            time = int(''.join([char for char in hop['time'] if char.isdigit()]))
+            time = hop.boil_time
+            if time is None:
+                raise ValueError('Invalid hop time: %r' % hop['time'])
+
             b = 1.65 * pow(0.000125, early_gu - 1.0) * ((1.0 - pow(2.718, -0.04 * time)) / 4.15) * ((hop['aa'] / 100.0 * hop['oz'] * 7490.0) / self.boil_size) * utilization_factor
             ibu += b
 
@@ -377,9 +401,8 @@ class RecipeBase(db.Model):
                 if full:
                     # Compare all values of the ingredients, yay another loop!
                     for prop in newIngredients[ingredient]:
-                        if prop not in oldIngredients[ingredient]:
-                            oldIngredients[ingredient][prop] = ''
-                        if newIngredients[ingredient][prop] != oldIngredients[ingredient][prop]:
+                        old_value = oldIngredients[ingredient].get(prop, '')
+                        if newIngredients[ingredient][prop] != old_value:
                             # Make the dictionary chain if necessary
                             if not 'ingredients' in modifications:
                                 modifications['ingredients'] = {}
@@ -392,7 +415,7 @@ class RecipeBase(db.Model):
 
                             # Finally set the value
                             modifications['ingredients'][type][ingredient][prop] = (
-                                oldIngredients[ingredient][prop],
+                                old_value,
                                 newIngredients[ingredient][prop]
                             )
                 elif newIngredients[ingredient] != oldIngredients[ingredient]:
@@ -470,9 +493,9 @@ class RecipeBase(db.Model):
            'steep_efficiency' in modifications:
 
             # Update the caches if needed
-            if not hasattr(self, 'color'):
+            if getattr(self, 'color', None) is None:
                 self.update_cache()
-            if not hasattr(other, 'color'):
+            if getattr(other, 'color', None) is None:
                 other.update_cache()
 
             # Compare color, ibu, and alcohol
@@ -514,6 +537,42 @@ class Recipe(RecipeBase):
     review_count = db.IntegerProperty(default=0)
     avg_review = db.FloatProperty(default=0.0)
 
+    # Number of clones and brews of this recipe, updated as they are
+    # created so that grading does not need to run count queries
+    clone_count = db.IntegerProperty(default=0)
+    brew_count = db.IntegerProperty(default=0)
+
+    # Grading information about the most recently started brews, newest
+    # first: the brew, its start date, its owner, how complete it is and
+    # its rating (zero if it is not rated). See record_brew().
+    recent_brews = db.ListProperty(db.Key, indexed=False)
+    recent_brew_started = db.ListProperty(datetime, indexed=False)
+    recent_brewers = db.ListProperty(db.Key, indexed=False)
+    recent_brew_completeness = db.ListProperty(float, indexed=False)
+    recent_brew_ratings = db.ListProperty(int, indexed=False)
+
+    # Number of recent brews to keep for grading
+    RECENT_BREWS = 25
+
+    # Fields kept up to date by update_stats() and regrade_recipe() rather
+    # than by the owner's edits, see put()
+    STATS_FIELDS = ('clone_count', 'brew_count', 'recent_brews',
+                    'recent_brew_started', 'recent_brewers',
+                    'recent_brew_completeness', 'recent_brew_ratings',
+                    'review_count', 'avg_review', 'grade')
+
+    # Time in seconds over which requests to regrade a recipe are combined
+    # into a single background regrade, see schedule_regrade()
+    REGRADE_WINDOW = 60
+
+    # Fields which are stored on each historic version, besides its name,
+    # stats and ingredients, see create_historic_version()
+    HISTORY_FIELDS = ('description', 'type', 'category', 'style',
+                      'batch_size', 'boil_size', 'bottling_temp',
+                      'bottling_pressure', 'mash_efficiency',
+                      'steep_efficiency', 'primary_days', 'secondary_days',
+                      'tertiary_days', 'aging_days')
+
     @staticmethod
     def new_from_beerxml(data):
         """
@@ -611,6 +670,51 @@ class Recipe(RecipeBase):
 
         return new_recipes
 
+    @staticmethod
+    def prefetch_owners(recipes, known=None):
+        """
+        Load the owners of a list of recipes with a single batch get and
+        attach them to the recipes, so that rendering `recipe.owner` does
+        not fetch each owner separately. Users in the optional `known` list
+        are attached without being fetched, and users already loaded during
+        this request are reused, see identity. Returns the recipes as a list.
+        """
+        recipes = list(recipes)
+
+        owners = {}
+        for user in known or []:
+            if user:
+                owners[user.key()] = identity.add(user)
+
+        missing = list(set([recipe.owner_key for recipe in recipes
+                            if recipe.owner_key and recipe.owner_key not in owners]))
+
+        if missing:
+            for user in identity.get_multi(missing):
+                if user:
+                    owners[user.key()] = user
+
+        for recipe in recipes:
+            if recipe.owner_key in owners:
+                recipe.owner = owners[recipe.owner_key]
+
+        return recipes
+
+    @staticmethod
+    def get_by_slug(owner, slug):
+        """
+        Get one of a user's recipes by its slug, loading it at most once
+        per request, see identity. The owner may be a user or a user key.
+        """
+        if isinstance(owner, db.Model):
+            owner = owner.key()
+
+        return identity.lookup(('Recipe', 'slug', owner, slug),
+            lambda: Recipe.all()\
+                          .filter('owner =', owner)\
+                          .filter('slug =', slug)\
+                          .get())
+
     @property
     def owner_key(self):
         return Recipe.owner.get_value_for_datastore(self)
@@ -625,9 +729,57 @@ class Recipe(RecipeBase):
     def put(self, *args):
         """
         Save this recipe, updating any caches as needed before writing
-        to the data store.
+        to the data store, and keep its URL path and summary up to date.
+
+        Clones, brews and regrades may have updated the STATS_FIELDS of a
+        saved recipe since it was loaded, so those are re-read in the same
+        transaction as the write instead of being overwritten.
+        """
+        from models.recipepath import RecipePath
+        from models.recipesummary import RecipeSummary
+
+        if self.is_saved():
+            def txn():
+                stored = db.get(self.key())
+
+                if stored:
+                    for name in Recipe.STATS_FIELDS:
+                        setattr(self, name, getattr(stored, name))
+
+                return super(Recipe, self).put(*args)
+
+            key = db.run_in_transaction(txn)
+        else:
+            key = super(Recipe, self).put(*args)
+
+        RecipePath.update(self)
+        RecipeSummary.update(self)
+
+        publish(RECIPE_CHANGED, self)
+
+        return key
+
+    def delete(self, *args):
         """
-        return super(Recipe, self).put(*args)
+        Delete this recipe, its URL paths and summary, releasing its slug,
+        uncounting it as a clone and invalidating any caches which show it.
+        """
+        from models.recipepath import RecipePath
+        from models.recipesummary import RecipeSummary
+
+        RecipePath.remove_all(self)
+        RecipeSummary.remove(self.key())
+        if self.owner_key and self.slug:
+            SlugReservation.release(self.owner_key, 'Recipe', '', self.slug)
+
+        cloned_from_key = Recipe.cloned_from.get_value_for_datastore(self)
+
+        super(Recipe, self).delete(*args)
+
+        if cloned_from_key:
+            Recipe.remove_clone(cloned_from_key)
+
+        publish(RECIPE_CHANGED, self)
 
     def create_historic_version(self):
         """
@@ -635,26 +787,200 @@ class Recipe(RecipeBase):
         are copied to the RecipeHistory with a link back to this recipe. The
         history is not yet commited to the datastore.
         """
-        return RecipeHistory(self, **{
+        values = dict([(name, getattr(self, name))
+                       for name in Recipe.HISTORY_FIELDS])
+
+        values.update({
             'created': self.edited,
             'name': self.name,
-            'description': self.description,
-            'type': self.type,
-            'category': self.category,
-            'style': self.style,
-            'batch_size': self.batch_size,
-            'boil_size': self.boil_size,
-            'bottling_temp': self.bottling_temp,
-            'bottling_pressure': self.bottling_pressure,
-            'mash_efficiency': self.mash_efficiency,
-            'steep_efficiency': self.steep_efficiency,
-            'primary_days': self.primary_days,
-            'secondary_days': self.secondary_days,
-            'tertiary_days': self.tertiary_days,
-            'aging_days': self.aging_days,
+            'color': self.color,
+            'ibu': self.ibu,
+            'alcohol': self.alcohol,
             '_ingredients': self._ingredients
         })
 
+        return RecipeHistory(self, **values)
+
+    def materialize_version(self, history):
+        """
+        Get an unsaved copy of this recipe as it was at a historic version,
+        e.g. to render or serialize that version. The copy keeps the current
+        name, slug and owner of this recipe so that links to it still work,
+        and stores the name of the version as `oldname`. It must never be
+        saved.
+        """
+        values = dict([(name, prop.get_value_for_datastore(self))
+                       for name, prop in Recipe.properties().items()])
+
+        for name in Recipe.HISTORY_FIELDS:
+            values[name] = getattr(history, name)
+
+        # Versions created before stats were stored show the current stats
+        if history.color is not None:
+            values.update({
+                'color': history.color,
+                'ibu': history.ibu,
+                'alcohol': history.alcohol
+            })
+
+        values['_ingredients'] = history.full_ingredients()
+
+        version = Recipe(**values)
+        version.old = True
+        version.oldname = history.name
+
+        return version
+
+    def record_brew(self, brew, new=False):
+        """
+        Update the stored brew statistics of this recipe with a new or
+        changed brew, keeping the RECENT_BREWS most recently started brews.
+        Set new if the brew was just created so that it is counted.
+        """
+        entries = [entry for entry in zip(self.recent_brews,
+                                          self.recent_brew_started,
+                                          self.recent_brewers,
+                                          self.recent_brew_completeness,
+                                          self.recent_brew_ratings)
+                   if entry[0] != brew.key()]
+
+        # Completeness of brew
+        completeness = 0.0
+
+        if brew.started:
+            completeness += 1.0
+
+        if brew.og and brew.fg:
+            completeness += 1.0
+
+        if brew.notes:
+            completeness += 1.0
+
+        # Brews without a start date sort last, as in a datastore query
+        entries.append((brew.key(), brew.started or datetime.min,
+                        brew.owner_key, completeness, int(brew.rating or 0)))
+
+        entries.sort(key=lambda entry: entry[1], reverse=True)
+        entries = entries[:self.RECENT_BREWS]
+
+        self.recent_brews = [entry[0] for entry in entries]
+        self.recent_brew_started = [entry[1] for entry in entries]
+        self.recent_brewers = [entry[2] for entry in entries]
+        self.recent_brew_completeness = [entry[3] for entry in entries]
+        self.recent_brew_ratings = [entry[4] for entry in entries]
+
+        if new:
+            self.brew_count += 1
+
+    def rebuild_stats(self):
+        """
+        Recalculate the stored clone count, brew count and recent brew
+        statistics of this recipe from the datastore. Normally these are
+        kept up to date as clones and brews are saved, so this is only
+        needed for existing recipes, see migrations.
+        """
+        from models.brew import Brew
+
+        self.clone_count = Recipe.all().filter('cloned_from =', self).count(limit=None)
+        self.brew_count = Brew.all().filter('recipe =', self).count(limit=None)
+
+        self.recent_brews = []
+        self.recent_brew_started = []
+        self.recent_brewers = []
+        self.recent_brew_completeness = []
+        self.recent_brew_ratings = []
+
+        for brew in Brew.all().filter('recipe =', self).order('-started')\
+                                                       .fetch(self.RECENT_BREWS):
+            self.record_brew(brew)
+
+    @staticmethod
+    def put_unedited(recipes):
+        """
+        Save a list of recipes without changing when they were last edited,
+        which every put would otherwise set since `edited` is auto_now.
+        Use this for writes which are not edits by the owner, e.g. grading
+        and migrations. Like db.put, this skips the path and cache updates
+        of put().
+        """
+        entities = []
+        for recipe in recipes:
+            entity = datastore.Entity.FromPb(db.model_to_protobuf(recipe))
+            entity['edited'] = recipe.edited
+            entities.append(entity)
+
+        datastore.Put(entities)
+
+    @staticmethod
+    def update_stats(key, update):
+        """
+        Apply an update function to the stored statistics of a recipe in a
+        transaction, so that concurrent clones and brews are all counted,
+        and schedule a regrade. Returns the updated recipe, or None if it
+        no longer exists.
+
+            Recipe.update_stats(recipe.key(), lambda r: r.record_brew(brew))
+
+        """
+        def txn():
+            recipe = db.get(key)
+            if not recipe:
+                return None
+
+            update(recipe)
+
+            # Only the recipe entity group may be written in the transaction,
+            # so the path and cache updates of put() are skipped here
+            Recipe.put_unedited([recipe])
+            return recipe
+
+        recipe = db.run_in_transaction(txn)
+        if not recipe:
+            return None
+
+        publish(RECIPE_CHANGED, recipe)
+
+        Recipe.schedule_regrade(key)
+
+        return recipe
+
+    @staticmethod
+    def add_clone(key):
+        """
+        Count a new clone of a recipe and schedule a regrade.
+        """
+        def update(recipe):
+            recipe.clone_count += 1
+
+        return Recipe.update_stats(key, update)
+
+    @staticmethod
+    def remove_clone(key):
+        """
+        Uncount a deleted clone of a recipe and schedule a regrade.
+        """
+        def update(recipe):
+            recipe.clone_count = max(0, recipe.clone_count - 1)
+
+        return Recipe.update_stats(key, update)
+
+    @staticmethod
+    def add_brew(key, brew, new=False):
+        """
+        Record a new or changed brew of a recipe and schedule a regrade.
+        """
+        return Recipe.update_stats(key, lambda recipe: recipe.record_brew(brew, new))
+
+    @staticmethod
+    def schedule_regrade(key):
+        """
+        Regrade a recipe in the background. All requests to regrade the same
+        recipe within REGRADE_WINDOW seconds result in a single regrade at
+        the end of the window, see tasks.defer_once.
+        """
+        tasks.defer_once(regrade_recipe, 'regrade-%d' % key.id(),
+                         Recipe.REGRADE_WINDOW, key)
+
     def update_grade(self):
         """
         Grade a recipe based on several factors:
@@ -675,15 +1001,14 @@ class Recipe(RecipeBase):
         least one of each type of ingredient. A normal user can clone and/or
         brew the recipe, making sure to fill in as much as possible for the
         brew.
-        """
-        from models.brew import Brew
 
+        Grading only reads the counts and recent brew statistics stored on
+        the recipe, so it never touches the datastore.
+        """
         grade = 0.0
 
-        clone_count = Recipe.all().filter('cloned_from =', self).count()
-        logging.info('clone count ' + str(clone_count))
-        brew_count = Brew.all().filter('recipe =', self).count()
-        brews = Brew.all().filter('recipe =', self).order('-started').fetch(25)
+        clone_count = self.clone_count
+        brew_count = self.brew_count
 
         # Grade completeness
         if self.name.lower() not in ['', 'untitled', 'untitled brew', 'no name']:
@@ -700,27 +1025,16 @@ class Recipe(RecipeBase):
 
         # Grade average weighted reviews
         count = 0
-        brewers = set()
+        brewers = set(self.recent_brewers)
         avg_review = 0.0
-        for i, brew in enumerate(brews):
-            brew_grade = 0.0
-
-            brewers.add(brew.owner_key)
-
-            # Completeness of brew
-            if brew.started:
-                brew_grade += 1.0
-
-            if brew.og and brew.fg:
-                brew_grade += 1.0
-
-            if brew.notes:
-                brew_grade += 1.0
+        for i, (completeness, rating) in enumerate(zip(self.recent_brew_completeness,
+                                                       self.recent_brew_ratings)):
+            brew_grade = completeness
 
             # Brew rating
-            if brew.rating:
-                brew_grade += brew.rating
-                avg_review += brew.rating
+            if rating:
+                brew_grade += rating
+                avg_review += rating
                 count += 1
 
             # Weighted average (0.5, 0.25, 0.125, ...)
@@ -743,8 +1057,394 @@ class Recipe(RecipeBase):
             self.avg_review = 0.0
 
 
+def regrade_recipe(key):
+    """
+    Update the grade of a recipe and its summary, see Recipe.update_grade.
+    This is run in the background via Recipe.schedule_regrade.
+    """
+    def txn():
+        recipe = db.get(key)
+
+        if recipe:
+            recipe.update_grade()
+            Recipe.put_unedited([recipe])
+
+        return recipe
+
+    recipe = db.run_in_transaction(txn)
+
+    if recipe:
+        from models.recipesummary import RecipeSummary
+
+        RecipeSummary.update(recipe)
+
+        publish(RECIPE_CHANGED, recipe)
+
+
 class RecipeHistory(RecipeBase):
+    """
+    A historic version of a recipe, stored as a child of the recipe. Each
+    version also stores how it is shown on the recipe history page: the
+    differences from the version before it and whether it is shown as a
+    full snippet. These are computed once when the version is created, see
+    record_changes().
+
+    Versions are numbered in order. Every KEYFRAME_INTERVAL versions the
+    full ingredients are stored as a keyframe, and versions in between
+    only store the changes to the ingredients of the version before them,
+    see store_delta(). Any version is rebuilt from its nearest keyframe
+    with a single query, and rebuilt versions are cached since they never
+    change.
+    """
     # The parent recipe that this is a historic version of
     #parent_recipe = db.ReferenceProperty(Recipe)
 
     created = db.DateTimeProperty()
+
+    # Position of this version in the recipe's history, starting at 1, or
+    # None for versions which have not been numbered yet
+    number = db.IntegerProperty()
+
+    # Serialized changes to the ingredients of the previous version, or
+    # None if this version is a keyframe which stores its full ingredients
+    _delta = db.TextProperty()
+
+    # Number of versions since the last keyframe, zero for keyframes
+    depth = db.IntegerProperty(default=0, indexed=False)
+
+    # Cached color, bitterness and alcohol of this version, None for
+    # versions created before these were stored
+    color = db.IntegerProperty()
+    ibu = db.FloatProperty()
+    alcohol = db.FloatProperty()
+
+    # Serialized JSON differences from the previous version, see diff()
+    _changes = db.TextProperty()
+
+    # Whether this is the first stored version of the recipe
+    first = db.BooleanProperty(default=False, indexed=False)
+
+    # Whether the history page shows this version as a snippet, and the
+    # color, bitterness and alcohol of the latest snippet up to and
+    # including this version
+    show_snippet = db.BooleanProperty(default=False, indexed=False)
+    snippet_stats = db.ListProperty(float, indexed=False)
+
+    # Differences which are not shown on the history page
+    IGNORED_KEYS = ('color', 'ibu', 'alcohol')
+
+    # Maximum number of versions between keyframes
+    KEYFRAME_INTERVAL = 10
+
+    # Time in seconds to keep rebuilt ingredients in memcache
+    CACHE_TIME = 7 * 24 * 60 * 60
+
+    # Modifications which always cause a snippet to be shown
+    SNIPPET_ITEMS = ('name', 'description')
+
+    # Change in color, bitterness or alcohol since the last snippet above
+    # which a new snippet is shown
+    SNIPPET_THRESHOLD = 0.1
+
+    @property
+    def changes(self):
+        """
+        Get the stored differences from the previous version, or None if
+        they have not been computed.
+        """
+        if self._changes is None:
+            return None
+
+        return json.loads(self._changes)
+
+    @property
+    def stats(self):
+        """
+        Get the color, bitterness and alcohol of this version as a list of
+        floats, calculating them for versions which do not store them.
+        """
+        if self.color is None:
+            self.update_cache()
+
+        return [float(self.color), float(self.ibu), float(self.alcohol)]
+
+    def record_changes(self, previous):
+        """
+        Store the differences between this version and the previous one,
+        which may be None if this is the first version, and decide whether
+        the history page shows this version as a snippet. A snippet is
+        shown when the name or description changed, or when the color,
+        bitterness or alcohol changed by more than SNIPPET_THRESHOLD since
+        the last snippet.
+        """
+        stats = self.stats
+
+        if previous is None:
+            self._changes = None
+            self.first = True
+            self.show_snippet = True
+            self.snippet_stats = stats
+            return
+
+        additions, deletions, modifications = self.diff(previous)
+
+        last_stats = previous.snippet_stats or previous.stats
+
+        show = False
+        for key in self.SNIPPET_ITEMS:
+            if key in modifications:
+                show = True
+
+        for value, last in zip(stats, last_stats):
+            if not last or abs(value / last - 1.0) > self.SNIPPET_THRESHOLD:
+                show = True
+
+        for key in self.IGNORED_KEYS:
+            if key in modifications:
+                del modifications[key]
+
+        self._changes = json.dumps([additions, deletions, modifications])
+        self.first = False
+        self.show_snippet = show
+        self.snippet_stats = show and stats or last_stats
+
+    @property
+    def ingredients(self):
+        """
+        Get the ingredients of this version, rebuilding them from the
+        nearest keyframe if only a delta is stored.
+        """
+        if self._delta is None:
+            return RecipeBase.ingredients.fget(self)
+
+        if not hasattr(self, '_rebuilt_ingredients'):
+            self._rebuilt_ingredients = parse_ingredients(decode(self.full_ingredients()))
+
+        return self._rebuilt_ingredients
+
+    @ingredients.setter
+    def ingredients(self, value):
+        """
+        Store the full ingredients, making this version a keyframe.
+        """
+        RecipeBase.ingredients.fset(self, value)
+        self._delta = None
+        self.depth = 0
+
+    @property
+    def cache_key(self):
+        return 'history-ingredients-' + str(self.key())
+
+    @property
+    def cache_dependency(self):
+        """
+        The name of the cache dependency of pages rendering this version,
+        which is bumped when the version is deleted, see util.cached_fragment.
+        """
+        return 'history-%d-%d' % (self.parent_key().id(), self.key().id())
+
+    def full_ingredients(self):
+        """
+        Get the serialized full ingredients of this version, rebuilding them
+        from the nearest keyframe and the deltas after it if needed. The
+        result is cached, so viewing a version is usually a single cache
+        get.
+        """
+        if self._delta is None:
+            return self._ingredients
+
+        if hasattr(self, '_full_ingredients'):
+            return self._full_ingredients
+
+        full = memcache.get(self.cache_key)
+
+        if full is None:
+            # Walk back to the nearest keyframe, which is at most
+            # KEYFRAME_INTERVAL versions away
+            chain = []
+            for version in RecipeHistory.all()\
+                                        .ancestor(self.parent_key())\
+                                        .filter('number <', self.number)\
+                                        .order('-number'):
+                chain.append(version)
+
+                if version._delta is None:
+                    break
+
+            if not chain or chain[-1]._delta is not None:
+                raise ValueError('No keyframe before version %s of recipe %d' % (
+                                 self.number, self.parent_key().id()))
+
+            ingredients = decode(chain[-1]._ingredients)
+            for version in reversed(chain[:-1]):
+                ingredients = apply_delta(ingredients, decode(version._delta))
+
+            full = encode(apply_delta(ingredients, decode(self._delta)))
+            memcache.set(self.cache_key, full, self.CACHE_TIME)
+
+        self._full_ingredients = full
+        return full
+
+    def store_delta(self, previous):
+        """
+        Number this version after the previous one, which may be None if
+        this is the first version, and store only the changes to the
+        previous version's ingredients unless this version should be a
+        keyframe. Versions which are already numbered keep their number.
+        """
+        full = self.full_ingredients()
+        ingredients = self.ingredients
+
+        if self.number is None:
+            if previous is None:
+                self.number = 1
+            elif previous.number is not None:
+                self.number = previous.number + 1
+
+        if previous is None or previous.number is None or \
+           previous.depth + 1 >= self.KEYFRAME_INTERVAL:
+            self._ingredients = full
+            self._delta = None
+            self.depth = 0
+            return
+
+        # Keep the full ingredients around for the rest of this request
+        self._rebuilt_ingredients = ingredients
+        self._full_ingredients = full
+
+        self._delta = encode(delta(previous.ingredients, ingredients))
+        self._ingredients = None
+        self.depth = previous.depth + 1
+
+    @staticmethod
+    def expand(history):
+        """
+        Load the full ingredients of all versions of a recipe, ordered from
+        oldest to newest, by applying their deltas in order instead of
+        rebuilding each version separately.
+        """
+        ingredients = None
+
+        for version in history:
+            if version._delta is None:
+                ingredients = decode(version._ingredients)
+            elif ingredients is None:
+                ingredients = decode(version.full_ingredients())
+            else:
+                ingredients = apply_delta(ingredients, decode(version._delta))
+
+            if version._delta is not None:
+                version._rebuilt_ingredients = parse_ingredients(ingredients)
+                version._full_ingredients = encode(ingredients)
+
+    @staticmethod
+    def retained(created, now, policy):
+        """
+        Get the indexes of the versions to keep from a list of creation
+        times, ordered from oldest to newest, according to a retention
+        policy like settings.HISTORY_RETENTION. The newest version in each
+        interval is kept, as are the first and latest versions.
+
+            >>> policy = [(7, 0), (60, 1), (None, 7)]
+            >>> now = datetime(2013, 7, 1)
+            >>> created = [datetime(2013, 1, 1), datetime(2013, 1, 2),
+            ...            datetime(2013, 1, 3), datetime(2013, 6, 1, 9),
+            ...            datetime(2013, 6, 1, 17), datetime(2013, 6, 2),
+            ...            datetime(2013, 6, 29, 9), datetime(2013, 6, 29, 17)]
+            >>> sorted(RecipeHistory.retained(created, now, policy))
+            [0, 2, 4, 5, 6, 7]
+
+        """
+        if not created:
+            return set()
+
+        keep = set([0, len(created) - 1])
+        buckets = {}
+
+        for index, time in enumerate(created):
+            age = (now - time).days
+
+            for tier, (max_age, interval) in enumerate(policy):
+                if max_age is None or age < max_age:
+                    break
+
+            if not interval:
+                keep.add(index)
+                continue
+
+            # Later versions replace earlier ones in the same interval
+            buckets[(tier, (time - datetime.min).days // interval)] = index
+
+        keep.update(buckets.values())
+
+        return keep
+
+    @staticmethod
+    def thin(recipe_key, now=None, policy=None):
+        """
+        Delete the historic versions of a recipe which are not kept by the
+        retention policy, settings.HISTORY_RETENTION by default. The changes
+        made in deleted versions are merged into the next surviving version,
+        whose differences, snippet decision and ingredient delta are
+        recomputed against the surviving version before it. Returns the
+        number of deleted versions.
+        """
+        history = list(RecipeHistory.all()\
+                                    .ancestor(recipe_key)\
+                                    .order('-created'))
+        history.reverse()
+
+        keep = RecipeHistory.retained([version.created for version in history],
+                                      now or datetime.now(),
+                                      policy or settings.HISTORY_RETENTION)
+
+        removed = [version for index, version in enumerate(history)
+                   if index not in keep]
+
+        if not removed:
+            return 0
+
+        RecipeHistory.expand(history)
+
+        # Rewrite every surviving version after the first deleted one, so
+        # that deltas and keyframes stay evenly spaced
+        first_removed = history.index(removed[0])
+
+        changed = []
+        previous = None
+        for index, version in enumerate(history):
+            if index not in keep:
+                continue
+
+            if index > first_removed:
+                version.record_changes(previous)
+                version.store_delta(previous)
+                changed.append(version)
+
+            previous = version
+
+        # Every version is a child of the recipe, so the rewrite and the
+        # deletion can be applied together
+        def txn():
+            db.put(changed)
+            db.delete(removed)
+
+        db.run_in_transaction(txn)
+
+        memcache.delete_multi([version.cache_key
+                               for version in changed + removed])
+
+        for version in removed:
+            bump_cache_version(version.cache_dependency)
+
+        return len(removed)
+
+    @staticmethod
+    def latest(recipe):
+        """
+        Get the most recent historic version of a recipe, if any.
+        """
+        return RecipeHistory.all()\
+                            .ancestor(recipe)\
+                            .order('-created')\
+                            .get()
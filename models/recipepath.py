@@ -0,0 +1,143 @@
+import identity
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from models.recipe import Recipe
+from models.userprefs import UserPrefs
+
+
+class RecipePath(db.Model):
+    """
+    An index mapping a recipe URL to the recipe and its owner. The key name
+    is built from the owner's username and the recipe slug, so that
+
+        /users/USERNAME/recipes/RECIPE-SLUG
+
+    resolves with a single cached get instead of a user query followed by
+    a recipe query. Paths are written when a recipe is saved and removed
+    when it is deleted or re-slugged. Every lookup is also checked against
+    the loaded recipe, so a path left behind by a rename is removed rather
+    than served.
+    """
+    owner = db.ReferenceProperty(UserPrefs, collection_name='recipe_paths')
+    recipe = db.ReferenceProperty(Recipe, collection_name='paths')
+
+    # Time in seconds to keep resolved paths in memcache
+    CACHE_TIME = 24 * 60 * 60
+
+    @staticmethod
+    def key_name_for(username, slug):
+        """
+        Get the key name of the path to a user's recipe.
+
+            >>> RecipePath.key_name_for(u'brewer', u'pale-ale')
+            u'brewer/pale-ale'
+
+        """
+        return username + '/' + slug
+
+    @staticmethod
+    def cache_key(key_name):
+        return 'recipepath-' + key_name.encode('utf-8')
+
+    @staticmethod
+    def resolve(username, slug):
+        """
+        Get the user and recipe for a recipe URL as a (user, recipe) pair,
+        either of which may be None if it does not exist. Falls back to
+        querying when no valid path is stored, and stores the path for
+        next time.
+        """
+        key_name = RecipePath.key_name_for(username, slug)
+
+        keys = memcache.get(RecipePath.cache_key(key_name))
+        if not keys:
+            path = RecipePath.get_by_key_name(key_name)
+            if path:
+                keys = [RecipePath.owner.get_value_for_datastore(path),
+                        RecipePath.recipe.get_value_for_datastore(path)]
+                memcache.set(RecipePath.cache_key(key_name), keys,
+                             RecipePath.CACHE_TIME)
+
+        if keys:
+            publicuser, recipe = identity.get_multi(keys)
+
+            if publicuser and recipe and publicuser.name == username and \
+               recipe.slug == slug and recipe.owner_key == publicuser.key():
+                recipe.owner = publicuser
+                identity.add(publicuser, ('UserPrefs', 'name', username))
+                identity.add(recipe, ('Recipe', 'slug', publicuser.key(), slug))
+                return publicuser, recipe
+
+            # The user or recipe was renamed or deleted since
+            RecipePath.remove(username, slug)
+
+        publicuser = UserPrefs.get_by_name(username)
+        recipe = None
+
+        if publicuser:
+            recipe = Recipe.get_by_slug(publicuser, slug)
+
+            if recipe:
+                recipe.owner = publicuser
+                RecipePath.update(recipe)
+
+        return publicuser, recipe
+
+    @staticmethod
+    def update(recipe):
+        """
+        Store the path to a saved recipe under its owner's current
+        username and its current slug. Nothing is written if the cached
+        path is already current.
+        """
+        if not recipe.owner_key or not recipe.slug:
+            return
+
+        key_name = RecipePath.key_name_for(recipe.owner.name, recipe.slug)
+        keys = [recipe.owner_key, recipe.key()]
+
+        if memcache.get(RecipePath.cache_key(key_name)) == keys:
+            return
+
+        RecipePath(key_name=key_name, owner=keys[0], recipe=keys[1]).put()
+        memcache.set(RecipePath.cache_key(key_name), keys, RecipePath.CACHE_TIME)
+
+    @staticmethod
+    def remove(username, slug):
+        """
+        Remove the path for a recipe URL, e.g. after the recipe is given a
+        new slug.
+        """
+        key_name = RecipePath.key_name_for(username, slug)
+
+        db.delete(db.Key.from_path('RecipePath', key_name))
+        memcache.delete(RecipePath.cache_key(key_name))
+
+    @staticmethod
+    def remove_all(recipe):
+        """
+        Remove every path pointing to a recipe, e.g. when it is deleted.
+        """
+        keys = RecipePath.all(keys_only=True).filter('recipe =', recipe).fetch(100)
+
+        db.delete(keys)
+        memcache.delete_multi([RecipePath.cache_key(key.name()) for key in keys])
+
+    @staticmethod
+    def reindex(user_key):
+        """
+        Replace all of a user's recipe paths with paths under her current
+        username. This is run in the background after a user is renamed.
+        """
+        user = db.get(user_key)
+        if not user:
+            return
+
+        old = list(RecipePath.all(keys_only=True).filter('owner =', user_key))
+        db.delete(old)
+        memcache.delete_multi([RecipePath.cache_key(key.name()) for key in old])
+
+        for recipe in Recipe.all().filter('owner =', user_key):
+            recipe.owner = user
+            RecipePath.update(recipe)
@@ -0,0 +1,110 @@
+from google.appengine.ext import db
+from invalidation import publish, USER_CHANGED
+from models.userprefs import UserPrefs
+
+
+class RecipeSummary(db.Model):
+    """
+    A lightweight copy of the fields of a recipe that list pages show:
+    its name, description, URL and stats. Summaries share the numeric id
+    of their recipe and are written whenever it is saved, so that lists
+    of recipes can be rendered without loading the ingredient and mash
+    data of every recipe or fetching every owner to build its URL.
+    """
+    owner = db.ReferenceProperty(UserPrefs, collection_name='recipe_summaries')
+
+    # The owner's username, used to build the recipe URL
+    owner_name = db.StringProperty(indexed=False)
+
+    name = db.StringProperty()
+    description = db.StringProperty(indexed=False)
+    slug = db.StringProperty(indexed=False)
+
+    color = db.IntegerProperty(default=1, indexed=False)
+    ibu = db.FloatProperty(default=0.0, indexed=False)
+    alcohol = db.FloatProperty(default=0.0, indexed=False)
+
+    grade = db.FloatProperty(default=0.0)
+
+    @staticmethod
+    def key_for(recipe_key):
+        """
+        Get the key of the summary of a recipe.
+        """
+        return db.Key.from_path('RecipeSummary', recipe_key.id())
+
+    @staticmethod
+    def from_recipe(recipe):
+        """
+        Build the summary of a saved recipe.
+        """
+        owner_key = recipe.owner_key
+
+        return RecipeSummary(key=RecipeSummary.key_for(recipe.key()),
+                             owner=owner_key,
+                             owner_name=owner_key and recipe.owner.name or None,
+                             name=recipe.name,
+                             description=recipe.description,
+                             slug=recipe.slug,
+                             color=recipe.color,
+                             ibu=recipe.ibu,
+                             alcohol=recipe.alcohol,
+                             grade=recipe.grade)
+
+    @staticmethod
+    def update(recipe):
+        """
+        Write the summary of a saved recipe.
+        """
+        RecipeSummary.from_recipe(recipe).put()
+
+    @staticmethod
+    def update_all(recipes):
+        """
+        Write the summaries of a list of saved recipes with a single batch
+        put. Owners should already be loaded, see Recipe.prefetch_owners.
+        """
+        db.put([RecipeSummary.from_recipe(recipe) for recipe in recipes])
+
+    @staticmethod
+    def remove(recipe_key):
+        """
+        Remove the summary of a recipe, e.g. when it is deleted.
+        """
+        db.delete(RecipeSummary.key_for(recipe_key))
+
+    @staticmethod
+    def rename_owner(user_key):
+        """
+        Store a user's current username on the summaries of all of her
+        recipes. This is run in the background after a user is renamed, so
+        lists cached in the meantime still show the old name and are
+        invalidated again once the summaries are written.
+        """
+        user = db.get(user_key)
+        if not user:
+            return
+
+        summaries = list(RecipeSummary.all().filter('owner =', user_key))
+
+        for summary in summaries:
+            summary.owner_name = user.name
+
+        db.put(summaries)
+
+        publish(USER_CHANGED, user)
+
+    @property
+    def owner_key(self):
+        return RecipeSummary.owner.get_value_for_datastore(self)
+
+    @property
+    def recipe_key(self):
+        return db.Key.from_path('Recipe', self.key().id())
+
+    @property
+    def url(self):
+        return '/users/%(username)s/recipes/%(slug)s' % {
+            'username': self.owner_name,
+            'slug': self.slug
+        }
@@ -0,0 +1,101 @@
+from google.appengine.ext import db
+
+
+class SlugReservation(db.Model):
+    """
+    A reserved slug, which makes sure that no two recipes of a user, or
+    brews of a user's recipe, can ever share a URL. Reservations are
+    stored as children of the owning user and keyed by the kind of entity,
+    a scope within which slugs must be unique (e.g. a recipe id for brews)
+    and the slug itself, so a slug is reserved with a few gets and a put
+    in a single transaction.
+
+    The reservation of a base slug, e.g. 'pale-ale', also remembers the
+    next numeric suffix to try, so that popular names get 'pale-ale7'
+    without first trying 'pale-ale1' through 'pale-ale6'.
+    """
+    # The next suffix to try when the base slug is taken
+    next_suffix = db.IntegerProperty(default=1, indexed=False)
+
+    @staticmethod
+    def key_for(owner_key, kind, scope, slug):
+        """
+        Get the key of a slug reservation.
+        """
+        return db.Key.from_path('SlugReservation',
+                                '%s:%s:%s' % (kind, scope, slug),
+                                parent=owner_key)
+
+    @staticmethod
+    def reserve(owner_key, kind, scope, base):
+        """
+        Reserve and return the base slug if it is free, otherwise the base
+        slug with the next free numeric suffix appended.
+        """
+        def txn():
+            base_key = SlugReservation.key_for(owner_key, kind, scope, base)
+            counter = db.get(base_key)
+
+            if not counter:
+                SlugReservation(key=base_key).put()
+                return base
+
+            while True:
+                slug = base + str(counter.next_suffix)
+                counter.next_suffix += 1
+
+                key = SlugReservation.key_for(owner_key, kind, scope, slug)
+                if not db.get(key):
+                    db.put([counter, SlugReservation(key=key)])
+                    return slug
+
+        return db.run_in_transaction(txn)
+
+    @staticmethod
+    def release(owner_key, kind, scope, slug):
+        """
+        Release a reserved slug, e.g. after the entity using it was given
+        a new slug or deleted.
+        """
+        db.delete(SlugReservation.key_for(owner_key, kind, scope, slug))
+
+    @staticmethod
+    def matches(base, slug, next_suffix):
+        """
+        Return whether a slug is the base slug or the base slug with one of
+        the numeric suffixes handed out for it so far, i.e. those below the
+        base reservation's next_suffix. Suffixes are appended without a
+        separator, so a name like 'Stout2013' whose slug merely starts with
+        the base does not match.
+
+            >>> SlugReservation.matches('pale-ale', 'pale-ale', 1)
+            True
+            >>> SlugReservation.matches('pale-ale', 'pale-ale12', 13)
+            True
+            >>> SlugReservation.matches('stout', 'stout2013', 3)
+            False
+            >>> SlugReservation.matches('pale-ale', 'pale-ale-2', 3)
+            False
+
+        """
+        if slug == base:
+            return True
+
+        suffix = slug[len(base):]
+
+        return slug.startswith(base) and suffix.isdigit() and \
+               not suffix.startswith('0') and int(suffix) < next_suffix
+
+    @staticmethod
+    def reserved(owner_key, kind, scope, base, slug):
+        """
+        Return whether a slug could have been reserved for base, in which
+        case an entity using it can keep it, see matches().
+        """
+        if slug == base:
+            return True
+
+        counter = db.get(SlugReservation.key_for(owner_key, kind, scope, base))
+
+        return counter is not None and \
+               SlugReservation.matches(base, slug, counter.next_suffix)
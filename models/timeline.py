@@ -0,0 +1,164 @@
+from bisect import bisect
+from datetime import datetime
+from google.appengine.ext import db, deferred
+from invalidation import publish, TIMELINE_CHANGED
+from models.follow import Follow
+from models.useraction import UserAction
+
+
+class TimelineChunk(db.Model):
+    """
+    A chunk of a user's activity timeline, which is the list of actions
+    taken by the user and everyone she follows. Each user's chunks are
+    stored as children of her UserPrefs entity. New actions are added to
+    the newest chunk until it holds CHUNK_SIZE actions, after which a new
+    chunk is started.
+
+    Timelines are written when an action is created (see fan_out) so
+    that reading one is a single ancestor query, no matter how many
+    users are being followed.
+    """
+    # Maximum number of actions stored in a single chunk
+    CHUNK_SIZE = 100
+
+    # Action keys and their creation times, both sorted oldest first
+    actions = db.ListProperty(db.Key, indexed=False)
+    times = db.ListProperty(datetime, indexed=False)
+
+    # When this chunk was started
+    created = db.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def append(user_key, action):
+        """
+        Add an action to a user's timeline, keeping the newest chunk in
+        time order even if actions arrive out of order.
+        """
+        def txn():
+            chunk = TimelineChunk.all()\
+                                 .ancestor(user_key)\
+                                 .order('-created')\
+                                 .get()
+
+            if not chunk or len(chunk.actions) >= TimelineChunk.CHUNK_SIZE:
+                chunk = TimelineChunk(parent=user_key)
+
+            if action.key() in chunk.actions:
+                return
+
+            index = bisect(chunk.times, action.created)
+            chunk.actions.insert(index, action.key())
+            chunk.times.insert(index, action.created)
+            chunk.put()
+
+        db.run_in_transaction(txn)
+
+        publish(TIMELINE_CHANGED, user_key)
+
+    @staticmethod
+    def recent_actions(user, limit=15):
+        """
+        Get up to limit of the most recent action keys from a user's
+        timeline, newest first. This reads the two newest chunks with a
+        single query so that a recently started chunk is padded out with
+        actions from the previous one. Actions are sorted by time across
+        both chunks, since backfilled actions may be older than those in
+        the chunk before them.
+        """
+        chunks = TimelineChunk.all()\
+                              .ancestor(user)\
+                              .order('-created')\
+                              .fetch(2)
+
+        entries = []
+        for chunk in chunks:
+            entries.extend(zip(chunk.times, chunk.actions))
+
+        entries.sort(key=lambda entry: entry[0], reverse=True)
+
+        return [key for created, key in entries[:limit]]
+
+    @staticmethod
+    def remove_owner(user_key, owner_key):
+        """
+        Remove all actions of a user from another user's timeline, e.g.
+        after she stopped following them.
+        """
+        for chunk_key in TimelineChunk.all(keys_only=True).ancestor(user_key):
+            chunk = db.get(chunk_key)
+            removed = set([action.key() for action in db.get(chunk.actions)
+                           if action and action.owner_key == owner_key])
+
+            if not removed:
+                continue
+
+            def txn():
+                chunk = db.get(chunk_key)
+                entries = [(key, created) for key, created in zip(chunk.actions, chunk.times)
+                           if key not in removed]
+                chunk.actions = [key for key, created in entries]
+                chunk.times = [created for key, created in entries]
+                chunk.put()
+
+            db.run_in_transaction(txn)
+
+        publish(TIMELINE_CHANGED, user_key)
+
+
+# Number of followers to update in each fan out task
+FAN_OUT_BATCH = 100
+
+
+def fan_out(action_key, cursor=None):
+    """
+    Append a newly created action to the timelines of its owner and each
+    of the owner's followers. This is run in the background via the task
+    queue and defers itself to handle large numbers of followers in
+    batches.
+    """
+    action = db.get(action_key)
+    if not action:
+        return
+
+    if cursor:
+        targets = []
+    else:
+        targets = [action.owner_key]
+
+    followers, next_cursor = Follow.followers(action.owner_key, FAN_OUT_BATCH,
+                                              cursor, keys_only=True)
+    targets.extend(followers)
+
+    for user_key in targets:
+        TimelineChunk.append(user_key, action)
+
+    if next_cursor:
+        deferred.defer(fan_out, action_key, next_cursor)
+
+
+# Number of earlier actions of a newly followed user added to a timeline
+BACKFILL_SIZE = 25
+
+
+def backfill(user_key, followed_key):
+    """
+    Add the most recent actions of a newly followed user to the timeline
+    of her new follower, which otherwise would only show the actions she
+    takes from now on. This is run in the background via the task queue.
+    """
+    actions = UserAction.all()\
+                        .filter('owner =', followed_key)\
+                        .order('-created')\
+                        .fetch(BACKFILL_SIZE)
+
+    for action in reversed(actions):
+        TimelineChunk.append(user_key, action)
+
+
+def prune(user_key, followed_key):
+    """
+    Remove the actions of a user who was unfollowed from the timeline of
+    her former follower. This is run in the background via the task
+    queue.
+    """
+    TimelineChunk.remove_owner(user_key, followed_key)
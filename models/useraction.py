@@ -1,4 +1,6 @@
-from google.appengine.ext import db
+import identity
+
+from google.appengine.ext import db, deferred
 from models.userprefs import UserPrefs
 
 
@@ -54,12 +56,88 @@ class UserAction(db.Model):
 
         return ids
 
+    @staticmethod
+    def resolve(actions, users=None, recipes=None, brews=None):
+        """
+        Load everything needed to render a list of actions: their owners,
+        the objects they refer to and the recipes of any brews. Returns
+        user, recipe and brew maps of id -> object, where recipes are
+        loaded as RecipeSummary objects keyed by recipe id. Summaries store
+        their owner's name for building URLs, so recipe owners are not
+        loaded.
+
+        Already loaded users, recipe summaries and brews can be passed in
+        so that they are not fetched again. Everything else is fetched
+        with at most two async batch gets, and everything loaded is added
+        to the request's identity map.
+        """
+        from models.recipesummary import RecipeSummary
+
+        maps = {
+            'UserPrefs': {},
+            'RecipeSummary': {},
+            'Brew': {}
+        }
+
+        for entity in (users or []) + (recipes or []) + (brews or []):
+            maps[entity.kind()][entity.key().id()] = identity.add(entity)
+
+        def fetch(keys):
+            keys = set([key for key in keys
+                        if key and key.id() not in maps[key.kind()]])
+
+            if keys:
+                for entity in db.get_async(list(keys)).get_result():
+                    if entity:
+                        maps[entity.kind()][entity.key().id()] = identity.add(entity)
+
+        # First the action owners and the objects the actions refer to
+        object_ids = UserAction.gather_object_ids(actions)
+
+        keys = [action.owner_key for action in actions]
+        for kind, name in [('UserPrefs', 'users'), ('RecipeSummary', 'recipes'),
+                           ('Brew', 'brews')]:
+            keys.extend([db.Key.from_path(kind, id) for id in object_ids[name]])
+
+        fetch(keys)
+
+        # Then the recipes of brews
+        fetch([brew.recipe_key and RecipeSummary.key_for(brew.recipe_key)
+               for brew in maps['Brew'].values()])
+
+        user_map, recipe_map, brew_map = maps['UserPrefs'], maps['RecipeSummary'], maps['Brew']
+
+        for brew in brew_map.values():
+            if brew.owner_key and brew.owner_key.id() in user_map:
+                brew.owner = user_map[brew.owner_key.id()]
+
+        return user_map, recipe_map, brew_map
+
     @property
     def owner_key(self):
         return UserAction.owner.get_value_for_datastore(self)
 
+    def put(self, *args):
+        """
+        Save this action. New actions are added to the timelines of the
+        owner and her followers in the background.
+        """
+        from models.timeline import fan_out
+
+        new = not self.is_saved()
+        key = super(UserAction, self).put(*args)
+
+        if new:
+            deferred.defer(fan_out, key)
+
+        return key
+
     @property
     def object(self):
+        """
+        Get the object this action refers to. This fetches the object on
+        every call, so use UserAction.resolve for lists of actions.
+        """
         if self.type in [self.TYPE_USER_FOLLOWED]:
             return UserPrefs.get_by_id(self.object_id)
         elif self.type in [self.TYPE_RECIPE_CREATED,
@@ -0,0 +1,141 @@
+import settings
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from models.userprefs import UserPrefs
+
+
+class Username(db.Model):
+    """
+    A registry of taken usernames. Each entity is keyed by a username and
+    refers to the user who has it, so checking whether a name is available
+    or finding the user with a name is a single cached get instead of a
+    query. Names are claimed in a transaction on their own entity, which
+    makes it impossible for two users to end up with the same name.
+
+    The entity for a name also remembers the next numeric suffix to try
+    when generating names from it, e.g. for new users named after their
+    email address.
+    """
+    user = db.ReferenceProperty(UserPrefs, collection_name='usernames')
+
+    # The next suffix to try when this name is taken
+    next_suffix = db.IntegerProperty(default=1, indexed=False)
+
+    # Time in seconds to keep looked up names in memcache
+    CACHE_TIME = 24 * 60 * 60
+
+    @staticmethod
+    def cache_key(name):
+        return 'username-' + name.encode('utf-8')
+
+    @staticmethod
+    def lookup(name):
+        """
+        Get the key of the user with a name, or None if the name is free.
+        Both outcomes are cached, and claiming or releasing a name updates
+        the cache.
+        """
+        user_id = memcache.get(Username.cache_key(name))
+
+        if user_id is None:
+            entity = Username.get_by_key_name(name)
+
+            if entity:
+                user_id = entity.user_key and entity.user_key.id() or 0
+            else:
+                # Names of users who joined before the registry existed are
+                # only registered by the usernames migration, so look for
+                # them directly until it has run
+                user_key = UserPrefs.all(keys_only=True)\
+                                    .filter('name =', name)\
+                                    .get()
+                user_id = user_key and user_key.id() or 0
+
+            memcache.set(Username.cache_key(name), user_id, Username.CACHE_TIME)
+
+        return user_id and db.Key.from_path('UserPrefs', user_id) or None
+
+    @staticmethod
+    def available(name):
+        """
+        Return whether a name is free to be claimed. Names listed in
+        settings.RESERVED_USERNAMES are never available.
+        """
+        return name not in settings.RESERVED_USERNAMES and not Username.lookup(name)
+
+    @staticmethod
+    def claim(name, user_key):
+        """
+        Claim a name for a user, returning False if it is reserved or
+        already taken by someone else.
+        """
+        if name in settings.RESERVED_USERNAMES:
+            return False
+
+        # Also catches unregistered names of existing users, see lookup
+        holder = Username.lookup(name)
+        if holder and holder != user_key:
+            return False
+
+        def txn():
+            entity = Username.get_by_key_name(name)
+
+            if entity and entity.user_key:
+                return entity.user_key == user_key
+
+            entity = entity or Username(key_name=name)
+            entity.user = user_key
+            entity.put()
+            return True
+
+        claimed = db.run_in_transaction(txn)
+
+        if claimed:
+            memcache.set(Username.cache_key(name), user_key.id(), Username.CACHE_TIME)
+
+        return claimed
+
+    @staticmethod
+    def release(name, user_key):
+        """
+        Release a name held by a user, e.g. after she picked a new one.
+        """
+        def txn():
+            entity = Username.get_by_key_name(name)
+
+            if entity and entity.user_key == user_key:
+                entity.user = None
+                entity.put()
+
+        db.run_in_transaction(txn)
+
+        memcache.delete(Username.cache_key(name))
+
+    @staticmethod
+    def allocate(base, user_key):
+        """
+        Claim and return the base name for a user if it is free, otherwise
+        the base name with the next free numeric suffix appended. Each
+        suffix is taken from a counter on the base name's entity, so
+        concurrent allocations never try the same name.
+        """
+        if Username.claim(base, user_key):
+            return base
+
+        def next_suffix():
+            entity = Username.get_by_key_name(base) or Username(key_name=base)
+            suffix = entity.next_suffix
+            entity.next_suffix += 1
+            entity.put()
+            return suffix
+
+        while True:
+            name = base + str(db.run_in_transaction(next_suffix))
+
+            if Username.claim(name, user_key):
+                return name
+
+    @property
+    def user_key(self):
+        return Username.user.get_value_for_datastore(self)
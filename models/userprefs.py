@@ -1,11 +1,13 @@
 import hashlib
-import settings
 
 from contrib.paodate import Date
 from datetime import datetime
 from google.appengine.api import users
 from google.appengine.api import memcache
+import identity
+
 from google.appengine.ext import db
+from invalidation import publish, USER_CHANGED
 
 
 class UserPrefs(db.Model):
@@ -38,32 +40,76 @@ class UserPrefs(db.Model):
     # user's name when logged in.
     unread_messages = db.IntegerProperty(default=0)
 
-    # List of user IDs that this user is following
+    # List of user IDs that this user is following. This mirrors the
+    # follow graph in models.follow, which should be used for lookups.
     following = db.StringListProperty()
 
+    # Cached number of recipes, brews and followers, updated as they are
+    # created and deleted so that pages do not need to run count queries.
+    recipe_count = db.IntegerProperty(default=0)
+    brew_count = db.IntegerProperty(default=0)
+    follower_count = db.IntegerProperty(default=0)
+
     # User location
     location = db.GeoPtProperty()
 
+    # Fields shown in cached lists of users and recipes. Changes to other
+    # fields, e.g. the email updated on every login, do not publish
+    # USER_CHANGED, so they do not invalidate those lists.
+    LISTED_FIELDS = ('name', 'avatar', 'recipe_count')
+
+    def __init__(self, *args, **kwargs):
+        super(UserPrefs, self).__init__(*args, **kwargs)
+
+        # The listed fields as last stored, or None for a new user
+        self._stored_listing = None
+        if kwargs.get('_from_entity'):
+            self._stored_listing = self.listing
+
     @staticmethod
     def get(auth_id):
         """
         Get or create the preferences database value for the
         currently logged in user. First try to get the object via
         memcache, falling back to the database and then updating
-        memcache for the next time the object is needed.
+        memcache for the next time the object is needed. The user is
+        loaded at most once per request, see identity.
         """
-        # Attempt to fetch from memcache
-        prefs = memcache.get('userprefs-' + auth_id)
+        def load():
+            # Attempt to fetch from memcache
+            prefs = memcache.get('userprefs-' + auth_id)
 
-        # Attempt to fetch from data store
-        if not prefs:
-            prefs = UserPrefs.all()\
-                             .filter('user_id =', auth_id).get()
+            # Attempt to fetch from data store
+            if not prefs:
+                prefs = UserPrefs.all()\
+                                 .filter('user_id =', auth_id).get()
 
-            if prefs:
-                memcache.add('userprefs-' + str(auth_id), prefs)
+                if prefs:
+                    memcache.add('userprefs-' + str(auth_id), prefs)
 
-        return prefs
+            return prefs
+
+        return identity.lookup(('UserPrefs', 'auth_id', auth_id), load)
+
+    @staticmethod
+    def get_by_name(name):
+        """
+        Get a user by her username via the username registry, loading her
+        at most once per request, see identity. Names missing from the
+        registry fall back to a query.
+        """
+        from models.username import Username
+
+        def load():
+            user_key = Username.lookup(name)
+            user = user_key and identity.get(user_key)
+
+            if user and user.name == name:
+                return user
+
+            return UserPrefs.all().filter('name =', name).get()
+
+        return identity.lookup(('UserPrefs', 'name', name), load)
 
     @staticmethod
     def create_or_update(auth_id, user_info, auth_info):
@@ -91,23 +137,18 @@ class UserPrefs(db.Model):
 
         # Not found yet... time to create a new one!
         if not prefs:
-            # Generate a nice username from the email
-            username = user_info['email'].split('@')[0].lower().replace(' ', '')
-            count = 0
+            from models.username import Username
 
-            while True:
-                check_name = count and username + str(count) or username
-                if not UserPrefs.all()\
-                                .filter('name =', check_name)\
-                                .count() and check_name not in settings.RESERVED_USERNAMES:
-                    if count:
-                        username = username + str(count)
-                    break
+            # Allocate an id up front so the new user can claim a name
+            key = db.Key.from_path('UserPrefs',
+                db.allocate_ids(db.Key.from_path('UserPrefs', 1), 1)[0])
 
-                count += 1
+            # Generate a nice username from the email
+            username = user_info['email'].split('@')[0].lower().replace(' ', '')
+            username = Username.allocate(username, key)
 
             # Create the preferences object and store it
-            prefs = UserPrefs(**{
+            prefs = UserPrefs(key=key, **{
                 'user_id': auth_id,
                 'name': username,
                 'joined': Date().date,
@@ -124,9 +165,6 @@ class UserPrefs(db.Model):
             action.type = action.TYPE_USER_JOINED
             action.put()
 
-            # Invalidate cached user list pages
-            memcache.delete('users-content')
-
         # Update fields based on latest user info
         prefs.email = user_info['email']
 
@@ -151,13 +189,42 @@ class UserPrefs(db.Model):
         """
         Save this object to the database, updating the memcache data as
         we do so to prevent cache misses on subsequent requests by this
-        user.
+        user. USER_CHANGED is only published if one of the LISTED_FIELDS
+        changed since the user was loaded.
         """
         super(UserPrefs, self).put(*args)
 
+        listing = self.listing
+        changed = listing != getattr(self, '_stored_listing', None)
+        self._stored_listing = listing
+
         # Update the cache, invalidating old data
         memcache.set('userprefs-' + str(self.user_id), self, 3600)
 
+        if changed:
+            publish(USER_CHANGED, self)
+
+    def adjust_count(self, name, delta=1):
+        """
+        Add delta to one of the cached counters, e.g. recipe_count, in a
+        transaction so that concurrent updates are not lost. This object
+        and the memcache copy are updated to match the stored value.
+        """
+        def txn():
+            prefs = db.get(self.key())
+            setattr(prefs, name, max(0, (getattr(prefs, name) or 0) + delta))
+            db.put(prefs)
+            return getattr(prefs, name)
+
+        setattr(self, name, db.run_in_transaction(txn))
+
+        # Drop the cached copy rather than risk caching other unsaved
+        # changes made to this object
+        memcache.delete('userprefs-' + str(self.user_id))
+
+        if name in UserPrefs.LISTED_FIELDS:
+            publish(USER_CHANGED, self)
+
     def name_crop(self, length=18):
         name = self.name
 
@@ -166,6 +233,14 @@ class UserPrefs(db.Model):
 
         return name
 
+    @property
+    def listing(self):
+        """
+        Get the values of the fields shown in cached lists, see
+        LISTED_FIELDS.
+        """
+        return tuple([getattr(self, name) for name in UserPrefs.LISTED_FIELDS])
+
     @property
     def is_admin(self):
         return 'admin' in self.awards
@@ -192,44 +267,42 @@ class UserPrefs(db.Model):
     @property
     def following_users(self):
         """
-        Get a list of UserPref objects for the users that this user is
-        currently following.
+        Get a list of UserPref objects for up to 100 of the users that
+        this user is currently following, most recently followed first.
         """
-        return UserPrefs.all()\
-                        .filter('user_id IN', self.following)
+        from models.follow import Follow
+
+        return Follow.following(self)[0]
 
     @property
     def top_interesting_recipes(self):
         """
         Get a list of the top recipes that are interesting for this user,
-        meaning that either the recipes belong to this user or any user
-        that she is following. The list is ranked by the number of likes
-        that each recipe has.
+        meaning recipes that were recently created, edited, cloned or
+        brewed by this user or anyone she is following. The list is taken
+        from the user's timeline and ranked by recipe grade.
         """
-        from models.recipe import Recipe
+        from models.timeline import TimelineChunk
+        from models.useraction import UserAction
 
-        following = self.following_users.run(batch_size=100)
+        actions = [action for action in db.get(TimelineChunk.recent_actions(self, 50))
+                   if action]
+        recipes = UserAction.resolve(actions, users=[self])[1].values()
 
-        return Recipe.all()\
-                     .filter('owner IN', [self] + list(following))\
-                     .order('-likes_count')\
-                     .fetch(15)
+        return sorted(recipes, key=lambda r: r.grade, reverse=True)[:15]
 
     @property
     def top_interesting_events(self):
         """
         Get a list of interesting events ordered by date from most
         recent to least. Interesting events are events that either belong
-        to this user or any user she is following.
+        to this user or any user she is following, and are read from the
+        user's timeline.
         """
-        from models.useraction import UserAction
-
-        following = self.following_users.run(batch_size=100)
+        from models.timeline import TimelineChunk
 
-        return UserAction.all()\
-                         .filter('owner IN', [self] + list(following))\
-                         .order('-created')\
-                         .fetch(25)
+        return [action for action in db.get(TimelineChunk.recent_actions(self, 25))
+                if action]
 
     @property
     def brewdays(self):
@@ -0,0 +1,299 @@
+"""
+Recipe Stats
+============
+A batch version of RecipeBase.update_cache, which calculates the color,
+bitterness, alcohol and calories of many recipes at once. Ingredients of
+all recipes are loaded into flat NumPy arrays with the index of their
+recipe, and each formula is then applied to every ingredient in a single
+vectorized pass, with per-recipe sums done via numpy.bincount. This is
+used to recompute the stored stats of every recipe after a formula
+changes, see migrations.
+
+The formulas, and the order of operations within them, mirror
+update_cache exactly so that both give identical results. Any change to
+update_cache (and static/scripts/main/recipe.coffee) must be made here
+too. This is checked against update_cache for a set of random recipes:
+
+    >>> import random
+    >>> from models.recipe import Recipe
+    >>> rand = random.Random(42)
+    >>> recipes = [_sample_recipe(Recipe(), rand) for i in range(250)]
+    >>> stats = calculate(recipes)
+    >>> for recipe in recipes:
+    ...     recipe.update_cache()
+    >>> stats == [(r.color, r.ibu, r.alcohol, r.calories) for r in recipes]
+    True
+
+"""
+
+import logging
+import numpy
+
+from models.recipe import RecipeBase
+
+# Names of the stats returned by calculate(), in order
+STATS = ('color', 'ibu', 'alcohol', 'calories')
+
+# Fermentable additions and how their gravity is adjusted by efficiency
+ADDITION_BOIL = 0
+ADDITION_STEEP = 1
+ADDITION_MASH = 2
+
+
+def _addition(description, mashing):
+    """
+    Classify a fermentable as boiled, steeped or mashed, see update_cache.
+    """
+    forced = True
+    if 'mashed' in description:
+        addition = ADDITION_MASH
+    elif 'steep' in description:
+        addition = ADDITION_STEEP
+    elif 'boil' in description:
+        addition = ADDITION_BOIL
+    else:
+        forced = False
+        if RecipeBase.RE_BOIL.search(description):
+            addition = ADDITION_BOIL
+        elif RecipeBase.RE_STEEP.search(description):
+            addition = ADDITION_STEEP
+        else:
+            addition = ADDITION_MASH
+
+    if mashing and addition == ADDITION_STEEP and not forced:
+        addition = ADDITION_MASH
+
+    return addition
+
+
+def _flatten(recipes):
+    """
+    Load the ingredients of a list of recipes into flat lists of values,
+    each with the index of its recipe. Recipes with ingredients that
+    update_cache cannot handle are logged and left out.
+    """
+    columns = dict([(name, []) for name in [
+        'batch_size', 'boil_size', 'attenuation',
+        'f_recipe', 'f_weight', 'f_color', 'f_ppg', 'f_efficiency', 'f_early',
+        'h_recipe', 'h_aa', 'h_oz', 'h_time', 'h_utilization'
+    ]])
+    valid = []
+
+    for recipe in recipes:
+        index = len(valid)
+
+        try:
+            ingredients = recipe.ingredients
+
+            mashing = False
+            for fermentable in ingredients['fermentables']:
+                desc = fermentable['description']
+                if 'mash' in desc or not ((RecipeBase.RE_STEEP.search(desc) or RecipeBase.RE_BOIL.search(desc))):
+                    mashing = True
+                    break
+
+            fermentables = []
+            for fermentable in ingredients['fermentables']:
+                addition = _addition(fermentable['description'], mashing)
+
+                if addition == ADDITION_STEEP:
+                    efficiency = recipe.steep_efficiency / 100.0
+                elif addition == ADDITION_MASH:
+                    efficiency = recipe.mash_efficiency / 100.0
+                else:
+                    efficiency = 1.0
+
+                early = not fermentable.is_late
+
+                fermentables.append((fermentable['weight'], fermentable['color'],
+                                     fermentable['ppg'], efficiency, early))
+
+            attenuation = 0
+            for yeast in ingredients['yeast']:
+                if yeast['attenuation'] > attenuation:
+                    attenuation = yeast['attenuation']
+
+            hops = []
+            for hop in ingredients['spices']:
+                if not hop['aa'] or hop['use'].lower() != 'boil':
+                    continue
+
+                utilization = 1.0
+                if hop['form'] == 'pellet':
+                    utilization = 1.15
+
+                time = hop.boil_time
+                if time is None:
+                    raise ValueError('Invalid hop time: %r' % hop['time'])
+
+                hops.append((hop['aa'], hop['oz'], time, utilization))
+        except (KeyError, TypeError, ValueError), e:
+            logging.warning('Cannot calculate stats of recipe %s: %s' % (
+                            recipe.is_saved() and recipe.key() or recipe.name, e))
+            continue
+
+        valid.append(recipe)
+        columns['batch_size'].append(recipe.batch_size)
+        columns['boil_size'].append(recipe.boil_size)
+        columns['attenuation'].append(attenuation or 75)
+
+        for weight, color, ppg, efficiency, early in fermentables:
+            columns['f_recipe'].append(index)
+            columns['f_weight'].append(weight)
+            columns['f_color'].append(color)
+            columns['f_ppg'].append(ppg)
+            columns['f_efficiency'].append(efficiency)
+            columns['f_early'].append(early)
+
+        for aa, oz, time, utilization in hops:
+            columns['h_recipe'].append(index)
+            columns['h_aa'].append(aa)
+            columns['h_oz'].append(oz)
+            columns['h_time'].append(time)
+            columns['h_utilization'].append(utilization)
+
+    return valid, columns
+
+
+def _sum(indices, values, count):
+    """
+    Sum values per recipe index, adding them in order like update_cache.
+    """
+    if not len(indices):
+        return numpy.zeros(count)
+
+    return numpy.bincount(indices, values, minlength=count)
+
+
+def calculate(recipes):
+    """
+    Calculate the color, bitterness, alcohol and calories of a list of
+    recipes, returning a list of (color, ibu, alcohol, calories) tuples in
+    the same order with the values update_cache would set. The entry of a
+    recipe whose ingredients cannot be handled is None.
+    """
+    recipes = list(recipes)
+    valid, columns = _flatten(recipes)
+    count = len(valid)
+
+    if not count:
+        return [None] * len(recipes)
+
+    def array(name, dtype=numpy.float64):
+        return numpy.array(columns[name], dtype=dtype)
+
+    batch_size = array('batch_size')
+    boil_size = array('boil_size')
+    attenuation = array('attenuation')
+
+    # Fermentables: color units and gravity, summed per recipe
+    f_recipe = array('f_recipe', numpy.intp)
+    f_weight = array('f_weight')
+    f_batch_size = batch_size[f_recipe]
+
+    mcu = _sum(f_recipe, array('f_color') * f_weight / f_batch_size, count)
+
+    gravity = array('f_ppg') * f_weight / f_batch_size * array('f_efficiency')
+
+    gu = 1.0 + (_sum(f_recipe, gravity, count) / 1000.0)
+    early_gu = 1.0 + (_sum(f_recipe, gravity * array('f_early', bool), count) / 1000.0)
+
+    # Alcohol and calories
+    fg = gu - ((gu - 1.0) * attenuation / 100.0)
+    abv = ((1.05 * (gu - fg)) / fg) / 0.79 * 100.0
+
+    bottle = 3.55 # 355 ml, aka standard 12oz bottle
+    gu_plato = (-463.37) + (668.72 * gu) - (205.35 * (gu * gu))
+    fg_plato = (-463.37) + (668.72 * fg) - (205.35 * (fg * fg))
+    real_extract = (0.1808 * gu_plato) + (0.8192 * fg_plato)
+    abw = 0.79 * abv / fg
+    calories = numpy.maximum(0, ((6.9 * abw) + 4.0 * (real_extract - 0.10)) * fg * bottle)
+
+    # Bitterness of boiled hops, summed per recipe
+    h_recipe = array('h_recipe', numpy.intp)
+
+    bitterness = 1.65 * numpy.power(0.000125, early_gu[h_recipe] - 1.0) * \
+                 ((1.0 - numpy.power(2.718, -0.04 * array('h_time'))) / 4.15) * \
+                 ((array('h_aa') / 100.0 * array('h_oz') * 7490.0) / boil_size[h_recipe]) * \
+                 array('h_utilization')
+
+    ibu = _sum(h_recipe, bitterness, count)
+
+    color = 1.4922 * numpy.power(mcu, 0.6859)
+
+    # Round with Python's round() so that halfway cases match update_cache
+    stats = {}
+    for index, recipe in enumerate(valid):
+        stats[id(recipe)] = (int(round(float(color[index]))),
+                             round(float(ibu[index]), 1),
+                             round(float(abv[index]), 1),
+                             int(round(float(calories[index]))))
+
+    return [stats.get(id(recipe)) for recipe in recipes]
+
+
+def apply(recipes):
+    """
+    Calculate and set the color, bitterness, alcohol and calories of a
+    list of recipes or historic versions, returning those whose values
+    changed. Only the stats an entity stores are set, e.g. historic
+    versions have no calories.
+    """
+    recipes = list(recipes)
+    changed = []
+
+    for recipe, values in zip(recipes, calculate(recipes)):
+        if values is None:
+            continue
+
+        values = dict(zip(STATS, values))
+        names = [name for name in STATS if name in recipe.properties()]
+
+        if [getattr(recipe, name) for name in names] != [values[name] for name in names]:
+            for name in names:
+                setattr(recipe, name, values[name])
+
+            changed.append(recipe)
+
+    return changed
+
+
+def _sample_recipe(recipe, rand):
+    """
+    Fill a recipe with random ingredients, used to check calculate against
+    update_cache.
+    """
+    descriptions = ['Pale malt', 'Pilsner', 'Extra pale liquid extract',
+                    'Caramel 40L', 'Crystal 60L', 'Chocolate malt',
+                    'Munich (mashed)', 'Victory steep', 'Candi sugar',
+                    'Honey', 'Wheat DME', 'Flaked oats boil']
+
+    recipe.batch_size = rand.choice([1.0, 2.5, 5.0, 5.5, 10.0])
+    recipe.boil_size = recipe.batch_size + rand.choice([0.5, 1.0, 1.5])
+    recipe.mash_efficiency = rand.randint(55, 85)
+    recipe.steep_efficiency = rand.randint(30, 60)
+
+    recipe.ingredients = {
+        'fermentables': [{
+            'description': rand.choice(descriptions),
+            'weight': round(rand.uniform(0.1, 12.0), 2),
+            'ppg': rand.randint(20, 46),
+            'color': rand.randint(1, 500),
+            'late': rand.choice(['', 'y', 'no'])
+        } for i in range(rand.randint(0, 6))],
+        'spices': [{
+            'description': '',
+            'use': rand.choice(['boil', 'Boil', 'primary', 'mash']),
+            'form': rand.choice(['pellet', 'leaf']),
+            'aa': round(rand.uniform(0.0, 16.0), 1),
+            'oz': round(rand.uniform(0.1, 3.0), 2),
+            'time': rand.choice(['60', '15 min', '5m', '90'])
+        } for i in range(rand.randint(0, 5))],
+        'yeast': [{
+            'description': '',
+            'form': 'liquid',
+            'attenuation': rand.choice([0, 68, 73, 80])
+        } for i in range(rand.randint(0, 2))]
+    }
+
+    return recipe
@@ -12,6 +12,10 @@ except ImportError:
 # and false when in production
 DEBUG = 'HTTP_HOST' in os.environ and os.environ['HTTP_HOST'].startswith('localhost') or False
 
+# The deployed version of the app, which changes whenever new code or
+# templates are uploaded
+VERSION = os.environ.get('CURRENT_VERSION_ID', 'dev')
+
 # The physical root directory of this project
 PROJECT_ROOT = dirname(__file__)
 
@@ -26,6 +30,17 @@ RESERVED_USERNAMES = [
     'super'
 ]
 
+# How long to keep historic versions of recipes, as a list of tiers of
+# (maximum age in days, interval in days). Versions younger than a tier's
+# maximum age keep only the newest version in each interval, where an
+# interval of 0 keeps every version. The last tier has no maximum age.
+# The first and latest versions of a recipe are always kept.
+HISTORY_RETENTION = [
+    (7, 0),
+    (60, 1),
+    (None, 7)
+]
+
 # A list of enabled providers. Possible options are defined in
 # handlers/auth.py:AuthHandler.AUTH_URLS
 AUTH_PROVIDERS = [
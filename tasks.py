@@ -0,0 +1,91 @@
+"""
+Background Tasks
+================
+Helpers to run work in the background on the task queue. Work can be
+coalesced by giving it a dedupe key: every request for the same key
+within a window of time maps to a single named task which runs once at
+the end of the window, so a burst of writes to one entity only causes
+one recomputation.
+
+    defer_once(regrade_recipe, 'regrade-%d' % key.id(), 60, key)
+
+Tests can install a LocalQueue, an in-process stand-in for the task
+queue which collects tasks and runs them on demand.
+"""
+
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+# An optional in-process stand-in for the task queue, see LocalQueue
+local_queue = None
+
+
+class LocalQueue(object):
+    """
+    An in-process stand-in for the task queue. Tasks with the same name
+    are only added once, like named tasks on the real queue, and nothing
+    runs until run() is called.
+
+        >>> queue = LocalQueue()
+        >>> calls = []
+        >>> queue.add('task-1', calls.append, ('first',))
+        True
+        >>> queue.add('task-1', calls.append, ('second',))
+        False
+        >>> queue.run()
+        1
+        >>> calls
+        ['first']
+
+    """
+    def __init__(self):
+        self.names = set()
+        self.tasks = []
+
+    def add(self, name, func, args):
+        """
+        Add a task, returning False if one with this name was added before.
+        """
+        if name in self.names:
+            return False
+
+        self.names.add(name)
+        self.tasks.append((func, args))
+        return True
+
+    def run(self):
+        """
+        Run all waiting tasks in the order they were added and return how
+        many were run.
+        """
+        tasks, self.tasks = self.tasks, []
+
+        for func, args in tasks:
+            func(*args)
+
+        return len(tasks)
+
+
+def defer_once(func, dedupe_key, window, *args):
+    """
+    Call func(*args) in the background at the end of the current window
+    of `window` seconds, unless that was already requested for the same
+    dedupe key during this window. The dedupe key may only contain
+    letters, digits, underscores and dashes. Returns True if a new task
+    was added.
+    """
+    now = int(time.time())
+    name = '%s-%d' % (dedupe_key, now // window)
+
+    if local_queue is not None:
+        return local_queue.add(name, func, args)
+
+    try:
+        deferred.defer(func, *args, _name=name,
+                       _countdown=window - now % window)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        return False
+
+    return True
@@ -1,3 +1,5 @@
+from google.appengine.ext import deferred
+from handlers.admin import MigrationHandler
 from handlers.auth import AuthHandler, AuthCallbackHandler, \
                           LoginHandler, LogoutHandler
 from handlers.brew import BrewHandler
@@ -16,6 +18,8 @@ from handlers.users import UsersHandler, UserHandler, UserFollowHandler, \
 # The following maps regular expressions to specific handlers.
 # Matched groups become positional arguments to the handler's methods.
 urls = [
+    ('/_ah/queue/deferred', deferred.TaskHandler),
+    ('/admin/migrate/(.+?)/?', MigrationHandler),
     ('/users/(.+?)/recipes/(.+?)/clone/?', RecipeCloneHandler),
     ('/users/(.+?)/recipes/(.+?)/brew/?', BrewHandler),
     ('/users/(.+?)/recipes/(.+?)/brew/(.+?)/?', BrewHandler),
@@ -1,11 +1,16 @@
 import datetime
+import identity
 import jinja2
 import random
 import re
 import settings
+import time
 
 from contrib.unidecode import unidecode
+from google.appengine.api import memcache
 from google.appengine.api import users
+from jinja2 import nodes
+from jinja2.ext import Extension
 from math import floor
 from xml.sax.saxutils import escape
 from operator import itemgetter
@@ -35,6 +40,10 @@ AWARDS = {
     'created10': ['book', 'Created 10 brews']
 }
 
+# Default time in seconds to keep rendered page fragments. Fragments are
+# invalidated by bumping the versions they depend on, so this can be long.
+FRAGMENT_CACHE_TIME = 24 * 60 * 60
+
 template_cache = {}
 
 
@@ -107,6 +116,105 @@ def get_template(name):
     return t
 
 
+def get_cache_versions(names):
+    """
+    Get the current versions of a list of named cache dependencies, e.g.
+    the list of all recipes, as a dictionary of name -> version. Cached
+    values which include these versions in their key become unreachable
+    as soon as a version is bumped, so nothing has to be deleted
+    explicitly.
+
+    New versions start at the current timestamp so that a version which
+    was evicted from memcache never restarts at an old value.
+    """
+    versions = memcache.get_multi(names, key_prefix='version-')
+
+    missing = dict([(name, int(time.time())) for name in names
+                    if name not in versions])
+
+    if missing:
+        memcache.add_multi(missing, key_prefix='version-')
+        versions.update(missing)
+
+    return versions
+
+
+def get_cache_version(name):
+    """
+    Get the current version of a single named cache dependency.
+    """
+    return get_cache_versions([name])[name]
+
+
+def bump_cache_version(name):
+    """
+    Bump the version of a named cache dependency, invalidating every
+    cached value that was built against the previous version.
+    """
+    memcache.incr('version-' + name, initial_value=int(time.time()))
+
+
+def cached_fragment(name, render_func, deps=None, cache_time=FRAGMENT_CACHE_TIME):
+    """
+    Get a rendered fragment of a page from memcache, or call render_func
+    to render it and cache the result. The cache key includes the current
+    version of each named dependency in deps, so bumping any of them via
+    bump_cache_version invalidates the fragment. Caching is skipped in
+    developer mode.
+
+        html = cached_fragment('index-recipes', render_recipes, ['recipes'])
+
+    """
+    deps = [str(dep) for dep in deps or []]
+    versions = get_cache_versions(deps)
+
+    key = 'fragment-' + name + ''.join(['-%s.%d' % (dep, versions[dep])
+                                        for dep in deps])
+
+    value = None
+    if not settings.DEBUG:
+        value = memcache.get(key)
+
+    if value is None:
+        value = render_func()
+        memcache.set(key, value, cache_time)
+
+    return value
+
+
+class FragmentCacheExtension(Extension):
+    """
+    A Jinja2 extension which adds a cache tag to templates. The first
+    argument is the fragment name and any others are the names of the
+    dependencies it is built from, see cached_fragment:
+
+        {% cache 'users-content', 'users' %}
+            ...
+        {% endcache %}
+
+    The body is only rendered when it is not found in the cache, so any
+    lazy queries it uses are never run on a cache hit.
+    """
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = parser.stream.next().lineno
+
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(self.call_method('_cache', [nodes.List(args)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _cache(self, args, caller):
+        return cached_fragment(args[0], caller, args[1:])
+
+JINJA_ENV.add_extension(FragmentCacheExtension)
+
+
 def render(handler, template, params=None, write_to_stream=True):
     """
     Render a page through Jinja2, passing in optional parameters.
@@ -377,6 +485,17 @@ JINJA_ENV.filters['timesince'] = timesince
 
 
 def recipe_snippet(value, show_owner=False):
+    from models.recipe import Recipe
+
+    # Every snippet links to its owner, so load the owners of recipes
+    # through the identity map to fetch each of them at most once per
+    # request. Summaries already store the owner's name.
+    if identity.active() and isinstance(value, Recipe) and value.owner_key:
+        owner = identity.get(value.owner_key)
+
+        if owner:
+            value.owner = owner
+
     return JINJA_ENV.get_template('recipe_snippet.html').render({
         'recipe': value,
         'show_owner': show_owner